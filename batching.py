@@ -0,0 +1,169 @@
+import threading
+import time
+from utils import write_event_log
+
+
+class TransientError(Exception):
+    """Raised by 'fetch' for failures unrelated to the requested ids
+    (network errors, rate limiting, server errors).
+    'retry_after' is the delay in seconds asked by the server, if any.
+    """
+    def __init__(self, message, retry_after:float=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RejectedIds(Exception):
+    """Raised by 'fetch' when the request was rejected because of some
+    of its ids. 'ids' are the rejected ones if the response names them,
+    otherwise None.
+    """
+    def __init__(self, message, ids:list=None):
+        super().__init__(message)
+        self.ids = ids
+
+
+class AdaptiveBatcher():
+    """Splits a list of ids into chunks for API calls.
+    The chunk size grows while requests are fast and successful
+    and shrinks when they become slow or return large payloads.
+    Chunks failing with a TransientError are retried with exponential
+    backoff and skipped after 'retries' attempts. Chunks raising
+    RejectedIds are sent again without the named ids or, if none are
+    named, bisected (at most 'max_depth' times) to isolate them.
+    Other failed chunks are skipped; other exceptions are raised.
+    """
+    def __init__(self, size=50, min_size=1, max_size=1000,
+                 target_latency=2.0, max_payload=10_000_000, retries=3,
+                 backoff=1.0, max_depth=8):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency  # Seconds per request
+        self.max_payload = max_payload  # Bytes per response
+        self.retries = retries
+        self.backoff = backoff  # Seconds before the first retry
+        self.max_depth = max_depth
+        # Chunk size: [requests, ids, seconds, bytes, errors]
+        self.stats = dict()
+        # A batcher can be shared by threads:
+        self._lock = threading.Lock()
+
+    def process(self, ids:list, fetch)->list:
+        """Returns a list of results for all the 'ids'.
+        'fetch(chunk)' must return a tuple of the result list
+        (None if the request failed) and the response size in bytes,
+        or raise TransientError or RejectedIds.
+        """
+        results = []
+        i = 0
+        while i < len(ids):
+            chunk = ids[i:i+self.size]
+            i += len(chunk)
+            results.extend(self._process_chunk(chunk, fetch))
+        return results
+
+    def _process_chunk(self, chunk:list, fetch, depth=0)->list:
+        try:
+            result, payload = self._fetch(chunk, fetch)
+        except RejectedIds as error:
+            return self._process_rejected(chunk, fetch, depth, error.ids)
+        if result is not None:
+            return result
+        if payload is None:
+            write_event_log(
+                f'{len(chunk)} ids skipped after {self.retries + 1} '
+                f'failed attempts, starting with {chunk[0]}',
+                'AdaptiveBatcher',
+            )
+        else:
+            write_event_log(
+                f'{len(chunk)} ids skipped after a failed request, '
+                f'starting with {chunk[0]}',
+                'AdaptiveBatcher',
+            )
+        return []
+
+    def _process_rejected(self, chunk:list, fetch, depth:int,
+                          rejected:list)->list:
+        rejected = set(rejected or ())
+        rest = [_id for _id in chunk if _id not in rejected]
+        if rejected and rest:
+            write_event_log(
+                f'Ids {sorted(rejected, key=str)} skipped: rejected',
+                'AdaptiveBatcher',
+            )
+            if depth >= self.max_depth:
+                return []
+            return self._process_chunk(rest, fetch, depth + 1)
+
+        # The rejected ids are unknown:
+        if len(chunk) == 1 or depth >= self.max_depth:
+            write_event_log(
+                f'{len(chunk)} ids skipped after a rejected request, '
+                f'starting with {chunk[0]}',
+                'AdaptiveBatcher',
+            )
+            return []
+        middle = len(chunk) // 2
+        return (self._process_chunk(chunk[:middle], fetch, depth + 1)
+                + self._process_chunk(chunk[middle:], fetch, depth + 1))
+
+    def _fetch(self, chunk:list, fetch)->tuple:
+        """Returns the result and the response size of the chunk.
+        The size is None if every attempt failed with a TransientError.
+        """
+        delay = 0
+        for _attempt in range(self.retries + 1):
+            time.sleep(delay)
+            _start = time.perf_counter()
+            try:
+                result, payload = fetch(chunk)
+            except TransientError as error:
+                self._record(len(chunk), time.perf_counter() - _start, 0,
+                             True)
+                delay = (error.retry_after if error.retry_after is not None
+                         else self.backoff * 2 ** _attempt)
+                continue
+            except RejectedIds:
+                self._record(len(chunk), time.perf_counter() - _start, 0,
+                             True)
+                raise
+            latency = time.perf_counter() - _start
+            self._record(len(chunk), latency, payload, result is None)
+            if result is not None:
+                self._tune(latency, payload)
+            return result, payload
+        return None, None
+
+    def _tune(self, latency:float, payload:int):
+        with self._lock:
+            if latency > self.target_latency or payload > self.max_payload:
+                self.size = max(self.min_size, self.size // 2)
+            elif latency < self.target_latency / 2:
+                self.size = min(self.max_size, self.size * 2)
+
+    def _record(self, size:int, latency:float, payload:int, failed:bool):
+        with self._lock:
+            _stats = self.stats.setdefault(size, [0, 0, 0.0, 0, 0])
+            _stats[0] += 1
+            _stats[1] += size
+            _stats[2] += latency
+            _stats[3] += payload
+            _stats[4] += int(failed)
+
+    def report(self)->str:
+        """Returns the throughput (ids per second) for each chunk size.
+        """
+        lines = []
+        with self._lock:
+            stats = sorted(
+                (_size, list(_stats)) for _size, _stats in self.stats.items()
+            )
+        for _size, (_requests, _ids, _seconds, _bytes, _errors) in stats:
+            _throughput = _ids / _seconds if _seconds else 0
+            lines.append(
+                f'size={_size} requests={_requests} '
+                f'ids/s={_throughput:.1f} bytes={_bytes} errors={_errors}'
+            )
+        return '\n'.join(lines)
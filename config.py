@@ -0,0 +1,54 @@
+import configparser
+import os
+
+
+# Pipeline stages in the order they run:
+STAGES = ('products', 'categories', 'category-attributes', 'dictionaries')
+
+# Section: {option: default value}
+DEFAULTS = {
+    'db': {
+        'type': 'postgresql',
+        'name': '',
+        'host': '',
+        'port': '',
+        'user': '',
+        'password': '',
+        # Connections shared by all stages and threads of a process:
+        'pool_size': '5',
+        'max_overflow': '10',  # Extra connections opened under load
+        'pool_timeout': '30',  # Seconds to wait for a free connection
+        'pool_recycle': '1800',  # Seconds before a connection is replaced
+    },
+    'run': {
+        # 'upsert' - add the account's records and remove its older duplicates,
+        # 'replace' - delete all of the account's records before writing.
+        'refresh_mode': 'upsert',
+        'workers': '1',  # Accounts and dictionaries processed in parallel
+        'writer_chunk_size': '1000',  # Records committed at once
+        'writer_queue_size': '4',  # Chunks waiting before fetching blocks
+    },
+}
+
+DEFAULT_CONFIG_PATH = 'config.ini'
+
+
+def load_config(path:str=None)->configparser.ConfigParser:
+    """Returns settings from the defaults, the INI file at 'path'
+    (or 'config.ini' if it exists) and 'OZON_<SECTION>_<OPTION>'
+    environment variables, the latter taking precedence.
+    """
+    config = configparser.ConfigParser()
+    config.read_dict(DEFAULTS)
+    if path:
+        with open(path, encoding='utf-8') as file:
+            config.read_file(file)
+    elif os.path.exists(DEFAULT_CONFIG_PATH):
+        config.read(DEFAULT_CONFIG_PATH, encoding='utf-8')
+
+    for _section, _options in DEFAULTS.items():
+        for _option in _options:
+            _variable = f'OZON_{_section}_{_option}'.upper()
+            if _variable in os.environ:
+                config[_section][_option] = os.environ[_variable]
+    return config
@@ -1,38 +1,121 @@
+import hashlib
+import json
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
 import sqlalchemy as sq
+import zstandard
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import sessionmaker
-from models import Account
+from models import (Account, ProductAttributes, CategoryAttributes, Job,
+                    ValueBlob)
 from utils import write_event_log
 
 
+# Text values of this length or longer are stored in 'value_blob':
+BLOB_MIN_SIZE = 256
+# Blobs of this size in bytes or larger are zstd-compressed:
+BLOB_COMPRESS_SIZE = 4096
+# Hashes of blobs known to be stored, kept to skip lookups:
+BLOB_CACHE_SIZE = 100_000
+
+# Materialized view of product attributes with resolved names and values:
+PRODUCT_VIEW = 'product_attr_resolved'
+
+
 class DbClient():
-    def __init__(self, db_type, db_name, host, port, user, password):
+    """All of the client's sessions share one engine connection pool
+    of 'pool_size' connections plus up to 'max_overflow' temporary ones.
+    A session waits up to 'pool_timeout' seconds for a free connection.
+    Connections are checked before use ('pool_pre_ping') and replaced
+    after 'pool_recycle' seconds.
+    """
+    def __init__(self, db_type, db_name, host, port, user, password,
+                 pool_size=5, max_overflow=10, pool_timeout=30,
+                 pool_recycle=1800, pool_pre_ping=True):
         self.db = (f'{db_type}://{user}:{password}'
                    f'@{host}:{port}/{db_name}')
         try:
-            self.engine = sq.create_engine(self.db)
+            self.engine = sq.create_engine(
+                self.db,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=pool_timeout,
+                pool_recycle=pool_recycle,
+                pool_pre_ping=pool_pre_ping,
+            )
         except sq.exc.NoSuchModuleError as error:
             write_event_log(error, 'DbClient.__init__')
             raise error
+        self.Session = sessionmaker(bind=self.engine)
+        self._known_blobs = set()
+        # Highest utilisation of the pool, reported by 'pool_status':
+        self._peak_checked_out = 0
+        self._peak_overflow = 0
+        self._pool_lock = threading.Lock()
+        sq.event.listen(self.engine.pool, 'checkout', self._on_checkout)
 
     def start_session(self):
+        """Returns a new session. It must be closed by the caller,
+        prefer 'session_scope' where possible.
+        """
         try:
-            Session = sessionmaker(bind=self.engine)
-            return Session()
+            return self.Session()
         except sq.exc.OperationalError as error:
             write_event_log(error, 'DbClient.start_session')
             raise error
 
+    @contextmanager
+    def session_scope(self):
+        """Provides a session that is committed on success,
+        rolled back on error and always returns its connection to the pool.
+        """
+        db_session = self.start_session()
+        try:
+            yield db_session
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            raise
+        finally:
+            db_session.close()
+
+    def pool_status(self)->dict:
+        """Returns the current connection pool utilisation
+        and its peak since the client was created.
+        """
+        pool = self.engine.pool
+        with self._pool_lock:
+            return {
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow(),
+                'peak_checked_out': self._peak_checked_out,
+                'peak_overflow': self._peak_overflow,
+            }
+
+    def _on_checkout(self, dbapi_connection, connection_record,
+                     connection_proxy):
+        pool = self.engine.pool
+        with self._pool_lock:
+            self._peak_checked_out = max(
+                self._peak_checked_out,
+                pool.checkedout(),
+            )
+            self._peak_overflow = max(self._peak_overflow, pool.overflow())
+
     def add_record(self, db_session, model, **kwargs):
         db_session.add(model(**kwargs))
         return db_session
 
     def get_credentials(self, mp_id)->list:
         credentials = []
-        db_session = self.start_session()
-        response = db_session.query(
-            Account.client_id_api,
-            Account.api_key,
-        ).filter(Account.mp_id == mp_id).all()
+        with self.session_scope() as db_session:
+            response = db_session.query(
+                Account.client_id_api,
+                Account.api_key,
+            ).filter(Account.mp_id == mp_id).all()
         for _item in response:
             credentials.append({
                 'client_id': _item[0],
@@ -40,20 +123,472 @@ class DbClient():
             })
         return credentials
 
-    def remove_duplicates(self, table, partition):
-        connection = self.engine.connect()
-        connection.execute(f"""
-            DELETE
-            FROM {table}
-            WHERE id IN (
-                SELECT id
-                FROM (
-                    SELECT id, 
-                    row_number() OVER (
-                        PARTITION BY {partition}
-                        ORDER BY id DESC
+    def get_category_ids(self, account_id)->set:
+        """Returns ids of the categories of the account's recorded products.
+        """
+        with self.session_scope() as db_session:
+            response = db_session.query(ProductAttributes.value).filter(
+                ProductAttributes.account_id == account_id,
+                ProductAttributes.attribute_id == 'category_id',
+                ProductAttributes.value != '0',
+            ).distinct().all()
+        return {int(_item[0]) for _item in response}
+
+    def get_named_attribute_ids(self, account_id)->list:
+        """Returns ids of the named (not numeric) attributes
+        of the account's recorded products.
+        """
+        with self.session_scope() as db_session:
+            response = db_session.query(ProductAttributes.attribute_id).filter(
+                ProductAttributes.account_id == account_id,
+                ProductAttributes.dictionary_value_id.is_(None),
+                ProductAttributes.complex_id.is_(None),
+                ProductAttributes.attribute_id != 'description',
+            ).distinct().all()
+        return [_item[0] for _item in response]
+
+    def get_dictionary_attributes(self, category_ids)->dict:
+        """Returns a dictionary with recorded categories and
+        their dictionary attributes ids.
+        """
+        dictionary_attributes = dict()
+        with self.session_scope() as db_session:
+            response = db_session.query(
+                CategoryAttributes.cat_id,
+                CategoryAttributes.chid,
+            ).filter(
+                CategoryAttributes.cat_id.in_(
+                    [str(_id) for _id in category_ids]
+                ),
+                CategoryAttributes.dictionary_id.isnot(None),
+                CategoryAttributes.dictionary_id != '0',
+            ).distinct().all()
+        for _item in response:
+            dictionary_attributes.setdefault(int(_item[0]), []).append(
+                int(_item[1])
+            )
+        return dictionary_attributes
+
+    def remove_account_records(self, db_session, model, account_id):
+        """Deletes all of the seller account's records of the model.
+        Used before re-adding the account's data in the same session,
+        so other accounts' rows are never touched.
+        """
+        db_session.query(model).filter(
+            model.account_id == account_id,
+        ).delete(synchronize_session=False)
+        return db_session
+
+    def remove_legacy_records(self, model, account_id):
+        """Deletes records without an account (written before accounts
+        were recorded) of the products now recorded for 'account_id'.
+        Scoped deduplication and replacement never match them, so
+        they would otherwise be kept next to the account's records.
+        """
+        table = model.__tablename__
+        with self.engine.begin() as connection:
+            connection.execute(sq.text(f"""
+                DELETE
+                FROM {table} legacy
+                WHERE legacy.account_id IS NULL
+                    AND EXISTS (
+                        SELECT 1
+                        FROM {table} owned
+                        WHERE owned.product_id = legacy.product_id
+                            AND owned.account_id = :account_id
+                    );
+            """), {'account_id': str(account_id)})
+
+    def remove_duplicates(self, table, partition, account_id=None,
+                          **filters):
+        """Keeps only the latest record of each partition.
+        If 'account_id' or other column 'filters' are passed,
+        only the matching records are scanned.
+        """
+        if account_id:
+            filters['account_id'] = account_id
+        params = {
+            _column: str(_value) for _column, _value in filters.items()
+        }
+        row_filter = ''
+        if params:
+            row_filter = 'WHERE ' + ' AND '.join(
+                f'{_column} = :{_column}' for _column in params
+            )
+        with self.engine.begin() as connection:
+            connection.execute(sq.text(f"""
+                DELETE
+                FROM {table}
+                WHERE id IN (
+                    SELECT id
+                    FROM (
+                        SELECT id, 
+                        row_number() OVER (
+                            PARTITION BY {partition}
+                            ORDER BY id DESC
+                        )
+                        FROM {table}
+                        {row_filter}) as query
+                    WHERE row_number != 1
+                );
+            """), params)
+
+    def create_job_table(self):
+        Job.__table__.create(self.engine, checkfirst=True)
+        # Tables created before leases were time zone aware:
+        columns = sq.inspect(self.engine).get_columns(Job.__tablename__)
+        lease_type = next(_column['type'] for _column in columns
+                          if _column['name'] == 'lease_expires_at')
+        if not getattr(lease_type, 'timezone', True):
+            with self.engine.begin() as connection:
+                connection.execute(sq.text(
+                    f'ALTER TABLE {Job.__tablename__} '
+                    'ALTER COLUMN lease_expires_at TYPE timestamptz'
+                ))
+
+    def clear_jobs(self, statuses=('done', 'failed')):
+        """Removes finished jobs, so their units can be enqueued again.
+        """
+        with self.session_scope() as db_session:
+            db_session.query(Job).filter(
+                Job.status.in_(statuses),
+            ).delete(synchronize_session=False)
+
+    def enqueue_jobs(self, kind:str, jobs:dict):
+        """Adds jobs of the 'kind' from a dictionary of unique keys
+        and payloads. Keys that are already queued are skipped.
+        """
+        if not jobs:
+            return
+        with self.session_scope() as db_session:
+            db_session.execute(
+                insert(Job).values([
+                    {
+                        'kind': kind,
+                        'key': _key,
+                        'payload': json.dumps(_payload),
+                        'status': 'pending',
+                        'attempts': 0,
+                    }
+                    for _key, _payload in jobs.items()
+                ]).on_conflict_do_nothing(index_elements=['key'])
+            )
+
+    def claim_job(self, worker_id:str, lease_seconds:int,
+                  max_attempts:int)->dict:
+        """Leases the oldest pending job or a job with an expired lease
+        to the worker. Jobs locked by other workers are skipped.
+        Returns the job's id, kind and payload or None.
+        """
+        with self.session_scope() as db_session:
+            # Expired jobs without attempts left are given up:
+            db_session.query(Job).filter(
+                Job.status == 'running',
+                Job.lease_expires_at < sq.func.now(),
+                Job.attempts >= max_attempts,
+            ).update(
+                {'status': 'failed', 'error': 'Lease expired'},
+                synchronize_session=False,
+            )
+            job = db_session.query(Job).filter(
+                sq.or_(
+                    Job.status == 'pending',
+                    sq.and_(
+                        Job.status == 'running',
+                        Job.lease_expires_at < sq.func.now(),
+                    ),
+                ),
+                Job.attempts < max_attempts,
+            ).order_by(Job.id).with_for_update(skip_locked=True).first()
+
+            claimed = None
+            if job is not None:
+                job.status = 'running'
+                job.worker_id = worker_id
+                job.attempts += 1
+                job.lease_expires_at = (sq.func.now()
+                                        + timedelta(seconds=lease_seconds))
+                claimed = {
+                    'id': job.id,
+                    'kind': job.kind,
+                    'payload': json.loads(job.payload),
+                }
+        return claimed
+
+    def _update_job(self, job_id:int, worker_id:str, values:dict)->bool:
+        """Updates the job if the worker still holds its lease.
+        """
+        with self.session_scope() as db_session:
+            updated = db_session.query(Job).filter(
+                Job.id == job_id,
+                Job.worker_id == worker_id,
+                Job.status == 'running',
+            ).update(values, synchronize_session=False)
+        return bool(updated)
+
+    def heartbeat_job(self, job_id:int, worker_id:str, lease_seconds:int,
+                      progress:str=None)->bool:
+        """Extends the job's lease. Returns False if the lease was lost.
+        """
+        return self._update_job(job_id, worker_id, {
+            'lease_expires_at': (sq.func.now()
+                                 + timedelta(seconds=lease_seconds)),
+            'progress': progress,
+        })
+
+    def complete_job(self, job_id:int, worker_id:str)->bool:
+        return self._update_job(job_id, worker_id, {
+            'status': 'done',
+            'lease_expires_at': None,
+        })
+
+    def fail_job(self, job_id:int, worker_id:str, error,
+                 max_attempts:int)->bool:
+        """Returns the job to the queue or marks it as failed
+        if it has no attempts left.
+        """
+        return self._update_job(job_id, worker_id, {
+            'status': sq.case(
+                (Job.attempts < max_attempts, 'pending'),
+                else_='failed',
+            ),
+            'lease_expires_at': None,
+            'error': str(error),
+        })
+
+    def get_job_counts(self)->list:
+        """Returns (kind, status, count) of the queued jobs.
+        """
+        with self.session_scope() as db_session:
+            response = db_session.query(
+                Job.kind,
+                Job.status,
+                sq.func.count(Job.id),
+            ).group_by(
+                Job.kind,
+                Job.status,
+            ).order_by(Job.kind, Job.status).all()
+        return [tuple(_item) for _item in response]
+
+    def store_blobs(self, values)->dict:
+        """Stores text values of at least BLOB_MIN_SIZE characters
+        in 'value_blob' once per content. Existing blobs are looked up
+        in bulk and never written again.
+        Returns a dictionary of the large values and their hashes.
+        """
+        blobs = dict()
+        for _value in values:
+            if isinstance(_value, str) and len(_value) >= BLOB_MIN_SIZE:
+                _data = _value.encode('utf-8')
+                blobs[hashlib.sha256(_data).hexdigest()] = (_value, _data)
+
+        missing = set(blobs) - self._known_blobs
+        if missing:
+            with self.session_scope() as db_session:
+                response = db_session.query(ValueBlob.hash).filter(
+                    ValueBlob.hash.in_(missing),
+                ).all()
+                stored = {_item[0] for _item in response}
+                new_blobs = []
+                for _hash in missing - stored:
+                    _data = blobs[_hash][1]
+                    _compression = None
+                    if len(_data) >= BLOB_COMPRESS_SIZE:
+                        _data = zstandard.ZstdCompressor().compress(_data)
+                        _compression = 'zstd'
+                    new_blobs.append({
+                        'hash': _hash,
+                        'compression': _compression,
+                        'size': len(blobs[_hash][1]),
+                        'data': _data,
+                    })
+                if new_blobs:
+                    # Another worker may store the same blob meanwhile:
+                    db_session.execute(
+                        insert(ValueBlob).values(new_blobs)
+                        .on_conflict_do_nothing(index_elements=['hash'])
                     )
-                    FROM {table}) as query
-                WHERE row_number != 1
-            );
-        """)
+
+            if len(self._known_blobs) > BLOB_CACHE_SIZE:
+                self._known_blobs = set()
+            self._known_blobs.update(missing)
+
+        return {_value: _hash for _hash, (_value, _) in blobs.items()}
+
+    def load_blobs(self, hashes)->dict:
+        """Returns a dictionary of the hashes and their stored values.
+        """
+        values = dict()
+        with self.session_scope() as db_session:
+            response = db_session.query(
+                ValueBlob.hash,
+                ValueBlob.compression,
+                ValueBlob.data,
+            ).filter(ValueBlob.hash.in_(set(hashes))).all()
+        for _hash, _compression, _data in response:
+            if _compression == 'zstd':
+                _data = zstandard.ZstdDecompressor().decompress(_data)
+            values[_hash] = bytes(_data).decode('utf-8')
+        return values
+
+    def create_product_view(self)->bool:
+        """Creates the materialized view of product attributes
+        with category attribute names and dictionary values resolved,
+        and the indexes of its lookups. Returns False if the view
+        already existed (and may need a refresh).
+        """
+        with self.engine.begin() as connection:
+            # Each product attribute looks up a row in each of these tables:
+            for _name, _table, _columns in (
+                # 'IS NOT DISTINCT FROM' can't use an index on account_id:
+                ('product_attr_lookup', 'product_attr',
+                 'product_id, attribute_id, account_id, id'),
+                ('cat_list_lookup', 'cat_list', 'cat_id, chid, id'),
+                ('attr_param_list_lookup', 'attr_param_list',
+                 'chid, attr_param_id, id'),
+            ):
+                connection.execute(sq.text(
+                    f'CREATE INDEX IF NOT EXISTS {_name} '
+                    f'ON {_table} ({_columns});'
+                ))
+
+            exists = connection.execute(
+                sq.text('SELECT to_regclass(:name)'),
+                {'name': PRODUCT_VIEW},
+            ).scalar() is not None
+            if exists:
+                return False
+            connection.execute(sq.text(f"""
+                CREATE MATERIALIZED VIEW {PRODUCT_VIEW} AS
+                SELECT
+                    pa.id,
+                    pa.account_id,
+                    pa.product_id,
+                    category.value AS category_id,
+                    pa.attribute_id,
+                    COALESCE(attribute.name, pa.attribute_id)
+                        AS attribute_name,
+                    COALESCE(dictionary.value, pa.value) AS value,
+                    pa.value_hash
+                FROM product_attr pa
+                LEFT JOIN LATERAL (
+                    SELECT value
+                    FROM product_attr
+                    WHERE product_id = pa.product_id
+                        AND account_id IS NOT DISTINCT FROM pa.account_id
+                        AND attribute_id = 'category_id'
+                    ORDER BY id DESC
+                    LIMIT 1
+                ) category ON true
+                LEFT JOIN LATERAL (
+                    SELECT name
+                    FROM cat_list
+                    WHERE cat_id = category.value
+                        AND chid = pa.attribute_id
+                    ORDER BY id DESC
+                    LIMIT 1
+                ) attribute ON true
+                LEFT JOIN LATERAL (
+                    SELECT value
+                    FROM attr_param_list
+                    WHERE chid = pa.attribute_id
+                        AND attr_param_id = pa.dictionary_value_id
+                    ORDER BY id DESC
+                    LIMIT 1
+                ) dictionary ON true;
+            """))
+            # Unique index allows refreshing without blocking readers:
+            connection.execute(sq.text(f"""
+                CREATE UNIQUE INDEX IF NOT EXISTS {PRODUCT_VIEW}_id
+                ON {PRODUCT_VIEW} (id);
+            """))
+            connection.execute(sq.text(f"""
+                CREATE INDEX IF NOT EXISTS {PRODUCT_VIEW}_product
+                ON {PRODUCT_VIEW} (account_id, product_id, id);
+            """))
+        return True
+
+    def refresh_product_view(self, concurrently=True):
+        """Updates the product view with the recorded data.
+        'concurrently' keeps the view readable during the refresh.
+        """
+        _concurrently = 'CONCURRENTLY' if concurrently else ''
+        with self.engine.begin() as connection:
+            connection.execute(sq.text(
+                f'REFRESH MATERIALIZED VIEW {_concurrently} {PRODUCT_VIEW};'
+            ))
+
+    def iter_products(self, product_ids:list=None, account_id=None,
+                      batch_size=1000):
+        """Yields products as dictionaries with 'account_id',
+        'product_id', 'category_id' and 'attributes' (attribute name:
+        value, or a list of values for repeated attributes).
+        Products are read from the product view with a server-side
+        cursor in batches of 'batch_size' rows, so memory use does not
+        depend on the number of products. 'product_ids' are looked up
+        'batch_size' at a time.
+        """
+        if product_ids is None:
+            yield from self._iter_product_rows(None, account_id, batch_size)
+            return
+        _product_ids = [str(_id) for _id in product_ids]
+        for i in range(0, len(_product_ids), batch_size):
+            yield from self._iter_product_rows(
+                _product_ids[i:i+batch_size],
+                account_id,
+                batch_size,
+            )
+
+    def _iter_product_rows(self, product_ids:list, account_id, batch_size):
+        conditions = []
+        params = {}
+        if product_ids is not None:
+            conditions.append('product_id = ANY(:product_ids)')
+            params['product_ids'] = product_ids
+        if account_id:
+            conditions.append('account_id = :account_id')
+            params['account_id'] = str(account_id)
+        row_filter = ''
+        if conditions:
+            row_filter = 'WHERE ' + ' AND '.join(conditions)
+
+        product = None
+        with self.engine.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True,
+                max_row_buffer=batch_size,
+            ).execute(sq.text(f"""
+                SELECT account_id, product_id, category_id,
+                    attribute_name, value, value_hash
+                FROM {PRODUCT_VIEW}
+                {row_filter}
+                ORDER BY account_id, product_id, id;
+            """), params)
+
+            for rows in result.partitions(batch_size):
+                _hashes = {_row.value_hash for _row in rows if _row.value_hash}
+                blobs = self.load_blobs(_hashes) if _hashes else dict()
+                for _row in rows:
+                    if (product is None
+                        or product['account_id'] != _row.account_id
+                        or product['product_id'] != _row.product_id):
+                        if product is not None:
+                            yield product
+                        product = {
+                            'account_id': _row.account_id,
+                            'product_id': _row.product_id,
+                            'category_id': _row.category_id,
+                            'attributes': dict(),
+                        }
+                    _value = (blobs.get(_row.value_hash)
+                              if _row.value_hash else _row.value)
+                    _attributes = product['attributes']
+                    _name = _row.attribute_name
+                    if _name not in _attributes:
+                        _attributes[_name] = _value
+                    elif isinstance(_attributes[_name], list):
+                        _attributes[_name].append(_value)
+                    else:
+                        _attributes[_name] = [_attributes[_name], _value]
+        if product is not None:
+            yield product
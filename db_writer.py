@@ -0,0 +1,180 @@
+import queue
+import threading
+from db_client import DbClient
+from models import ProductAttributes
+from utils import write_event_log
+
+
+class DbWriter():
+    """Writes records to the DB in a background thread.
+    Records are added through writer sessions ('session'), which can be
+    used in place of DB sessions. Each writer session collects records
+    into chunks of 'chunk_size' which the writer thread writes while
+    fetching continues. When 'queue_size' chunks are waiting,
+    'add' blocks until the DB catches up.
+    Large product attribute values are moved to 'value_blob'
+    with one lookup per chunk.
+    """
+    def __init__(self, db:DbClient, chunk_size=1000, queue_size=4):
+        self.db = db
+        self.chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._write,
+            name='DbWriter',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def session(self, atomic=False):
+        """Returns a new writer session.
+        Records of an 'atomic' session are written in a single
+        transaction committed by its 'commit', otherwise every chunk
+        is committed as soon as it is written.
+        """
+        return WriterSession(self, atomic)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _put(self, session, kind:str, payload=None):
+        with self._condition:
+            session._pending += 1
+        while True:
+            self._check_thread()
+            try:
+                self._queue.put((session, kind, payload), timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _check_thread(self):
+        # Callers would wait forever for a writer thread that has stopped:
+        if not self._thread.is_alive():
+            raise RuntimeError('DbWriter thread has stopped')
+
+    def _wait(self, session):
+        with self._condition:
+            while session._pending:
+                self._check_thread()
+                self._condition.wait(timeout=1)
+
+    def _write(self):
+        shared_session = self.db.start_session()
+        # Writer session: its own DB session with an open transaction
+        atomic_sessions = dict()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            session, kind, payload = item
+            if session.atomic:
+                db_session = atomic_sessions.get(session)
+                if db_session is None:
+                    db_session = self.db.start_session()
+                    atomic_sessions[session] = db_session
+            else:
+                db_session = shared_session
+
+            try:
+                if kind == 'commit':
+                    if session.atomic:
+                        del atomic_sessions[session]
+                        if session._error is None:
+                            db_session.commit()
+                        db_session.close()
+                elif session._error is not None and session.atomic:
+                    pass  # The transaction is lost, skip up to 'commit'
+                elif kind == 'execute':
+                    payload(db_session)
+                    if not session.atomic:
+                        db_session.commit()
+                else:
+                    self._store_blobs(payload)
+                    db_session.add_all(payload)
+                    if session.atomic:
+                        db_session.flush()
+                    else:
+                        db_session.commit()
+            except Exception as error:
+                if session._error is None:
+                    session._error = error
+                try:
+                    db_session.rollback()
+                    write_event_log(error, 'DbWriter._write')
+                except Exception:
+                    pass  # The error is raised by the session's 'commit'
+            finally:
+                # Written records are not needed in the writer's memory:
+                db_session.expunge_all()
+                with self._condition:
+                    session._pending -= 1
+                    self._condition.notify_all()
+
+        for _db_session in atomic_sessions.values():
+            _db_session.rollback()
+            _db_session.close()
+        shared_session.close()
+
+    def _store_blobs(self, records:list):
+        """Replaces large values of the product attribute 'records'
+        with references to 'value_blob'.
+        Blobs are committed at once, outside of the records' transaction:
+        they are only stored once and can be shared by any records.
+        """
+        records = [_record for _record in records
+                   if isinstance(_record, ProductAttributes)]
+        value_hashes = self.db.store_blobs(
+            [_record.value for _record in records]
+        )
+        for _record in records:
+            if (isinstance(_record.value, str)
+                    and _record.value in value_hashes):
+                _record.value_hash = value_hashes[_record.value]
+                _record.value = None
+
+
+class WriterSession():
+    """Collects records for the DbWriter thread. Can be shared by
+    threads. 'commit' waits until all of the session's records are
+    written and raises the first error that occurred meanwhile.
+    """
+    def __init__(self, writer:DbWriter, atomic=False):
+        self.writer = writer
+        self.atomic = atomic
+        self._chunk = []
+        self._lock = threading.Lock()
+        self._pending = 0  # Items queued but not written yet
+        self._error = None
+
+    def add(self, record):
+        with self._lock:
+            self._chunk.append(record)
+            if len(self._chunk) < self.writer.chunk_size:
+                return
+            chunk, self._chunk = self._chunk, []
+        self.writer._put(self, 'records', chunk)
+
+    def execute(self, function):
+        """Calls 'function(db_session)' in the writer thread,
+        in the session's transaction.
+        """
+        self._flush()
+        self.writer._put(self, 'execute', function)
+
+    def commit(self):
+        self._flush()
+        self.writer._put(self, 'commit')
+        self.writer._wait(self)
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _flush(self):
+        with self._lock:
+            chunk, self._chunk = self._chunk, []
+        if chunk:
+            self.writer._put(self, 'records', chunk)
@@ -1,631 +1,393 @@
-import requests
-import sqlalchemy
-from db_client import DbClient
-from models import (ProductAttributes, Category, CategoryAttributes,
-                       AttributeDictionaryValue)
-from ozon_api import OzonApi
-from utils import write_event_log
-
-
-# DB settings:
-TYPE= 'postgresql'
-NAME= ''
-HOST= ''
-PORT= ''
-USER= ''
-PASSWORD= ''
-
-
-def collect_product_ids(ozon:OzonApi, product_ids:list=None, 
-                        last_id:str='')->list:
-    """Returns a list of client's product ids.
-    Iterates over large lists of products with recursive self-calls.
+import argparse
+import sys
+from config import STAGES, load_config
+
+
+def connect(config):
+    """Returns a DB client and the accounts' credentials.
     """
-    product_ids = product_ids or []
-    try:
-        response = ozon.product_list(last_id=last_id)
-    except requests.exceptions.ConnectionError as error:
-        write_event_log(error, 'ozon.product_list')
-        return product_ids
+    # Heavy dependencies are only imported by commands using the DB:
+    import sqlalchemy
+    from db_client import DbClient
+    from utils import write_event_log
+
+    _db = config['db']
+    db = DbClient(
+        _db['type'],
+        _db['name'],
+        _db['host'],
+        _db['port'],
+        _db['user'],
+        _db['password'],
+        pool_size=_db.getint('pool_size'),
+        max_overflow=_db.getint('max_overflow'),
+        pool_timeout=_db.getint('pool_timeout'),
+        pool_recycle=_db.getint('pool_recycle'),
+    )
 
     try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as error:
-        write_event_log(error, 'collect_product_ids', response.json())
-        return product_ids
+        credentials = db.get_credentials(mp_id=1)
+    except (
+        sqlalchemy.exc.OperationalError,
+        sqlalchemy.exc.InternalError,
+        sqlalchemy.exc.ProgrammingError,
+    ) as error:
+        write_event_log(error, 'DbClient.get_credentials')
+        raise error
+    return db, credentials
+
+def create_pipeline(args, config, db, **kwargs):
+    from db_writer import DbWriter
+    from pipeline import Pipeline
+
+    _run = config['run']
+    store = None
+    transport = None
+    if args.record or args.replay:
+        from transport import RecordingTransport, RecordStore, ReplayTransport
+
+        store = RecordStore(args.record or args.replay)
+        if args.record:
+            transport = RecordingTransport(store)
+        else:
+            transport = ReplayTransport(store)
+    # Records are committed in the background while fetching continues:
+    db_writer = DbWriter(
+        db,
+        _run.getint('writer_chunk_size'),
+        _run.getint('writer_queue_size'),
+    )
+    return Pipeline(
+        db,
+        db_writer,
+        args.stages or STAGES,
+        category_ids=set(args.category) if args.category else None,
+        refresh_mode=args.refresh_mode or _run['refresh_mode'],
+        workers=args.workers or _run.getint('workers'),
+        transport=transport,
+        # Replayed requests must match the recorded ones:
+        adaptive_batching=store is None,
+        # A replayed failure is the same on every retry:
+        retries=0 if args.replay else 3,
+        **kwargs,
+    )
 
-    try:
-        result = response.json()['result']
-    except KeyError as error:
-        write_event_log(error, 'collect_product_ids', response.json())
-        return product_ids
+def log_pool_status(db):
+    from utils import write_event_log
 
-    try:
-        products = result['items']
-    except KeyError as error:
-        write_event_log(error, 'collect_product_ids', response.json())
-        return product_ids
-    
-    try:
-        assert isinstance(products, list)
-    except AssertionError:
-        write_event_log(
-            f'{type(products)} is not "list" object',
-            'collect_product_ids',
-        )
-        return product_ids
-
-    if products:
-        for _entry in products:
-            try:
-                product_ids.append(_entry['product_id'])
-            except KeyError as error:                
-                write_event_log(error, 'collect_product_ids', response.json())
-                return product_ids
-        try:        
-            return collect_product_ids(ozon, product_ids, result['last_id'])
-        except KeyError as error:
-            write_event_log(error, 'collect_product_ids', response.json())
-            return product_ids
-    else:
-        return product_ids
+    write_event_log(db.pool_status(), 'DbClient.pool_status')
 
-def collect_products_attributes(ozon:OzonApi, product_ids:list,)->list:
-    """Returns a list of attributes of the client's products.
-    """
-    _product_ids = (product_ids if isinstance(product_ids, list) 
-                else [product_ids])
-    products_with_attributes = []
-    for i in range(0, len(_product_ids), 50):
-        try:
-            response = ozon.product_attributes(_product_ids[i:i+50])
-        except requests.exceptions.ConnectionError as error:
-            write_event_log(error, 'ozon.product_attributes')
-            continue
-
-        try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as error:
-            write_event_log(
-                error,
-                'collect_products_attributes',
-                response.json(),
-            )
-            continue
-
-        try:
-            result = response.json()['result']
-        except KeyError as error:
-            write_event_log(
-                error,
-                'collect_products_attributes',
-                response.json(),
-            )
-            continue
-
-        try:        
-            for _entry in result:
-                products_with_attributes.append(_entry)
-        except TypeError as error:
-            write_event_log(
-                error,
-                'collect_products_attributes',
-            )
-
-    return products_with_attributes
-
-def add_product_attribute_records(ozon:OzonApi, db:DbClient,
-                                  db_session, product:dict):
-    """Gets the product description. Returns a DB session with
-    created product attributes and description records.
+def filter_accounts(args, credentials:list)->list:
+    if not args.account:
+        return credentials
+    return [
+        _entry for _entry in credentials
+        if _entry['client_id'] in args.account
+    ]
+
+def run(args, config):
+    """Runs the selected stages of the pipeline.
     """
-    # Get product description:
-    try:
-        response = ozon.product_description(product.get('id'))
-    except requests.exceptions.ConnectionError as error:
-        write_event_log(error, 'ozon.product_description')
-        product_description = None
+    from profiling import NullProfiler, StageProfiler
 
-    try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as error:
-        write_event_log(
-            error,
-            'add_product_attribute_records',
-            response.json(),
-        )
-        product_description = None
+    if args.profile:
+        profiler = StageProfiler(args.profile, args.flamegraph)
+    else:
+        profiler = NullProfiler()
 
+    db, credentials = connect(config)
+    pipeline = create_pipeline(args, config, db, profiler=profiler)
     try:
-        product_description = response.json()['result']['description']
-    except KeyError as error:
-        write_event_log(
-            error,
-            'add_product_attribute_records',
-            response.json(),
-        )
-        product_description = None
-
-    if product_description:
-        try:
-            db_session = db.add_record(
-                db_session=db_session,
-                model=ProductAttributes,
-                product_id=product['id'],
-                attribute_id='description',
-                value=product_description, 
-                mp_id=1,
-                db_i=f"{product['id']}description",
-            )
-        except KeyError as error:
-            write_event_log(
-                error,
-                'add_product_attribute_records',
-            )
-
-    # Get product attributes:
-    LIST_ATTRIBUTES = (
-        'images',
-        'images360',
-        'pdf_list',
-        'complex_attributes',
+        pipeline.run(filter_accounts(args, credentials))
+    finally:
+        pipeline.db_writer.close()
+        profiler.close()
+        log_pool_status(db)
+
+def enqueue(args, config):
+    """Starts a distributed run: fills the DB job queue with accounts.
+    """
+    from worker import enqueue_accounts
+
+    db, credentials = connect(config)
+    enqueue_accounts(db, filter_accounts(args, credentials))
+
+def work(args, config):
+    """Runs jobs from the DB job queue. Any number of workers
+    can run on different hosts at once.
+    """
+    from worker import JobWorker, default_worker_id, report_progress
+
+    db, _ = connect(config)
+    db.create_job_table()
+    stages = args.stages or STAGES
+    pipeline = create_pipeline(
+        args,
+        config,
+        db,
+        on_progress=report_progress,
+    )
+    # Each thread claims its own jobs, so parallelism comes from threads:
+    pipeline.workers = 1
+    worker = JobWorker(
+        db,
+        pipeline,
+        args.worker_id or default_worker_id(),
+        dictionaries='dictionaries' in stages,
+        lease_seconds=args.lease,
+        max_attempts=args.max_attempts,
+        exit_when_idle=args.exit_when_idle,
     )
     try:
-        for _key, _value in product.items():
-            if _key in LIST_ATTRIBUTES:
-                value_list = []
-                for _item in _value:
-                    try:
-                        value_list.append(_item['file_name'])
-                    except KeyError as error:
-                        write_event_log(
-                            error,
-                            'add_product_attribute_records',
-                        )
-                _complex_value = '|'.join(value_list) if value_list else None
-                try:    
-                    db_session = db.add_record(
-                        db_session=db_session,
-                        model=ProductAttributes,
-                        product_id=product['id'],
-                        attribute_id=_key,
-                        value=_complex_value, 
-                        mp_id=1,
-                        db_i=f"{product['id']}{_key}",
-                    )
-                except KeyError as error:
-                    write_event_log(
-                        error,
-                        'add_product_attribute_records',
-                    )
-
-            elif _key == 'attributes':
-                for _attribute in _value:
-                    for _item in _attribute.get('values'):
-                        try:
-                            db_session = db.add_record(
-                                db_session=db_session,
-                                model=ProductAttributes,
-                                product_id=product['id'],
-                                attribute_id=_attribute['attribute_id'],
-                                value=_item['value'],
-                                dictionary_value_id=_item[
-                                                'dictionary_value_id'],
-                                complex_id=_attribute['complex_id'], 
-                                mp_id=1,
-                                db_i=(f"{product['id']}"
-                                      f"{_attribute['attribute_id']}"),
-                            )
-                        except KeyError as error:
-                            write_event_log(
-                                error,
-                                'add_product_attribute_records',
-                            )
-
-            elif _key not in ('id', 'last_id'):
-                try:
-                    db_session = db.add_record(
-                        db_session=db_session,
-                        model=ProductAttributes,
-                        product_id=product['id'],
-                        attribute_id=_key,
-                        value=_value,
-                        mp_id=1,
-                        db_i=f"{product['id']}{_key}",
-                    )
-                except KeyError as error:
-                    write_event_log(
-                        error,
-                        'add_product_attribute_records',
-                    )
-    except TypeError as error:
-        write_event_log(
-            error,
-            'add_product_attribute_records',
-        )
-
-    return db_session
-
-def add_category_records(ozon:OzonApi, db:DbClient, category_ids:set,
-                         db_session):
-    """Returns a DB session with created category records.
+        worker.run(args.workers or config['run'].getint('workers'))
+    finally:
+        pipeline.db_writer.close()
+        log_pool_status(db)
+
+def show_jobs(args, config):
+    """Prints the number of queued jobs by kind and status.
     """
-    if (hasattr(category_ids, '__iter__') and
-        not isinstance(category_ids, str)):
-        _category_ids = category_ids
-    else:
-        _category_ids = [category_ids]
-
-    for _category in _category_ids:
-        try:
-            response = ozon.category_info(_category)
-        except requests.exceptions.ConnectionError as error:
-            write_event_log(error, 'ozon.category_info')
-            continue
-
-        try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as error:
-            write_event_log(error, 'add_category_records', response.json())
-            continue
-
-        try:
-            _category_info = response.json()['result'][0]
-        except (TypeError, KeyError) as error:
-            write_event_log(error, 'add_category_records', response.json())
-            continue
-
-        if _category_info:
-            try:
-                db_session = db.add_record(
-                    db_session=db_session,
-                    model=Category,
-                    name=_category_info['title'],
-                    cat_id=_category_info['category_id'],
-                    mp_id=1,
-                )
-            except KeyError as error:
-                write_event_log(error, 'add_category_records', response.json())
-        
-    return db_session
-
-def add_category_attribute_records(ozon:OzonApi, db:DbClient,
-                    category_ids:set, named_attribute_ids:list, db_session):
-    """Returns a DB session with created category attribute records.
-    Also returns a dictionary with categories and dictionary attributes ids
-    needed to get dictionary values.
+    db, _ = connect(config)
+    db.create_job_table()
+    for _kind, _status, _count in db.get_job_counts():
+        print(f'{_kind:<12}{_status:<10}{_count}')
+
+def refresh_view(args, config):
+    """Creates or refreshes the product view read by 'export'.
     """
-    dictionary_attributes = dict()
-    if (hasattr(category_ids, '__iter__') and
-        not isinstance(category_ids, str)):
-        _category_ids = list(category_ids)
-    else:
-        _category_ids = [category_ids]
-
-    for i in range(0, len(_category_ids), 20):
-        try:
-            response = ozon.category_attributes(_category_ids[i:i+20])
-        except requests.exceptions.ConnectionError as error:
-            write_event_log(error, 'ozon.category_attributes')
-            continue
-
-        try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as error:
-            write_event_log(
-                error,
-                'add_category_attribute_records',
-                response.json(),
-            )
-            continue
-
-        try:
-            _category_attributes = response.json()['result']
-        except (TypeError, KeyError) as error:
-            write_event_log(error, 'add_category_records', response.json())
-            continue
-
-        try:
-            for _category in _category_attributes:
-                dictionary_attributes[_category['category_id']] = []
-                for _attribute in _category['attributes']:
-                    db_session = db.add_record(
-                        db_session=db_session,
-                        model=CategoryAttributes,
-                        chid=_attribute['id'],
-                        name=_attribute['name'],
-                        is_required=_attribute['is_required'],
-                        is_collection=_attribute['is_collection'],
-                        type=_attribute['type'],
-                        description=_attribute['description'],
-                        dictionary_id=_attribute['dictionary_id'],
-                        group_name=_attribute['group_name'],
-                        cat_id=_category['category_id'],
-                        db_i=f"{_category['category_id']}{_attribute['id']}"
-                    )
-                
-                    if _attribute['dictionary_id'] != 0:
-                        dictionary_attributes[_category['category_id']].append(
-                            _attribute['id']
-                        )
-
-                for _named_attribute in named_attribute_ids:
-                    db_session = db.add_record(
-                        db_session=db_session,
-                        model=CategoryAttributes,
-                        chid=_named_attribute,
-                        name=_named_attribute,
-                        is_required=True,
-                        is_collection=False,
-                        type='',
-                        description=_named_attribute,
-                        dictionary_id=None,
-                        group_name=None,
-                        cat_id=_category['category_id'],
-                        db_i=f"{_category['category_id']}{_named_attribute}"
-                    )
-        except (TypeError, KeyError) as error:
-            write_event_log(
-                error,
-                'add_category_records',
-            )
-            continue
-
-    return db_session, dictionary_attributes
-
-def add_dictionary_attribute_value_records(ozon:OzonApi, db:DbClient,
-                        category_id, attribute_id, last_value_id:int=None):
-    """Creates records of the attribute's dictionary values in the DB.
+    db, _ = connect(config)
+    # A newly created view already holds the current data:
+    if not db.create_product_view():
+        db.refresh_product_view()
+
+def export(args, config):
+    """Streams products with resolved attributes as JSON lines.
     """
-    try:
-        response = ozon.attribute_dictionary_values(
-            category_id,
-            attribute_id,
-            last_value_id,
-        )
-    except requests.exceptions.ConnectionError as error:
-        write_event_log(error, 'ozon.attribute_dictionary_values')
-        return
+    import json
 
-    try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as error:
-        write_event_log(
-            error,
-            'add_dictionary_attribute_value_records',
-            response.json(),
-        )
-        return
+    db, _ = connect(config)
+    product_ids = args.product
+    if args.products_file:
+        with open(args.products_file, encoding='utf-8') as file:
+            product_ids = [_line.strip() for _line in file if _line.strip()]
 
+    output = (open(args.output, 'w', encoding='utf-8') if args.output
+              else sys.stdout)
     try:
-        _dictionary_values = response.json()['result']
-    except KeyError as error:
-        write_event_log(
-            error,
-            'add_dictionary_attribute_value_records',
-            response.json(),
-        )
-        return
-
-    if _dictionary_values:
-        db_session = db.start_session()
-        for _value in _dictionary_values:
-            try:
-                db_session = db.add_record(
-                    db_session=db_session,
-                    model=AttributeDictionaryValue,
-                    value=_value['value'],
-                    picture=_value['picture'],
-                    info=_value['info'],
-                    attr_param_id=_value['id'],
-                    chid=attribute_id,
-                    db_i=f"{attribute_id}{_value['id']}"
-                )
-            except KeyError as error:
-                write_event_log(
-                    error,
-                    'add_dictionary_attribute_value_records',
-                )
-        db_session.commit()
-
-    #Remove duplicates
-    try:
-        db.remove_duplicates(AttributeDictionaryValue.__tablename__, 'db_i')
-    except (
-        sqlalchemy.exc.InternalError,
-        sqlalchemy.exc.IntegrityError,
-        sqlalchemy.exc.ProgrammingError,
-        sqlalchemy.exc.DataError,
-        sqlalchemy.exc.OperationalError,
-    ) as error:
-        write_event_log(
-            error,
-            'add_dictionary_attribute_value_records db.remove_duplicates',
-        )
+        for _product in db.iter_products(
+            product_ids,
+            args.account,
+            args.batch_size,
+        ):
+            output.write(json.dumps(_product, ensure_ascii=False) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
 
-    try:
-        if response.json()['has_next']:
-            add_dictionary_attribute_value_records(
-                ozon,
-                db,
-                category_id,
-                attribute_id,
-                _value['id'],
-            )
-    except KeyError as error:
-        write_event_log(
-            error,
-            "'add_dictionary_attribute_value_records' recursive self-call",
-            response.json(),
-        )
+def recording_stats(args, config):
+    """Prints request latency statistics of a recording.
+    """
+    from transport import RecordStore
+
+    store = RecordStore(args.path)
+    print(f"{'endpoint':<40}{'requests':>9}{'mean':>9}{'p50':>9}"
+          f"{'p95':>9}{'max':>9}{'total':>10}")
+    for _stats in store.latency_stats():
+        print(f"{_stats['endpoint']:<40}{_stats['requests']:>9}"
+              f"{_stats['mean']:>9.3f}{_stats['p50']:>9.3f}"
+              f"{_stats['p95']:>9.3f}{_stats['max']:>9.3f}"
+              f"{_stats['total']:>10.1f}")
+    store.close()
+
+def show_config(args, config):
+    """Prints the effective settings with the password hidden.
+    """
+    for _section in config.sections():
+        print(f'[{_section}]')
+        for _option, _value in config[_section].items():
+            if _option == 'password' and _value:
+                _value = '***'
+            print(f'{_option} = {_value}')
+        print()
+
+def parse_args(argv:list=None):
+    parser = argparse.ArgumentParser(
+        description="Records Ozon sellers' products, categories and "
+                    "attribute dictionaries in the DB.",
+    )
+    parser.add_argument(
+        '--config',
+        metavar='PATH',
+        help='INI file with [db] and [run] sections (default: config.ini); '
+             'OZON_<SECTION>_<OPTION> environment variables override it',
+    )
+    commands = parser.add_subparsers(dest='command')
+
+    # Options shared by the commands running the pipeline:
+    stage_options = argparse.ArgumentParser(add_help=False)
+    stage_options.add_argument(
+        '--stages',
+        nargs='+',
+        choices=STAGES,
+        help='stages to run (default: all); data for later stages '
+             'is read from the DB when earlier ones are skipped',
+    )
+    stage_options.add_argument(
+        '--category',
+        action='append',
+        type=int,
+        metavar='CATEGORY_ID',
+        help='only process this category in the category stages '
+             '(can be repeated)',
+    )
+    stage_options.add_argument(
+        '--workers',
+        type=int,
+        help='accounts and dictionaries processed in parallel',
+    )
+    stage_options.add_argument(
+        '--refresh-mode',
+        choices=('upsert', 'replace'),
+    )
+    transport_options = stage_options.add_mutually_exclusive_group()
+    transport_options.add_argument(
+        '--record',
+        metavar='PATH',
+        help='save every API response to the recording at PATH '
+             '(batch sizes are fixed)',
+    )
+    transport_options.add_argument(
+        '--replay',
+        metavar='PATH',
+        help='answer API requests from the recording at PATH '
+             'instead of the network',
+    )
 
+    run_parser = commands.add_parser(
+        'run',
+        parents=[stage_options],
+        help='run pipeline stages',
+    )
+    run_parser.set_defaults(handler=run)
+    run_parser.add_argument(
+        '--account',
+        action='append',
+        metavar='CLIENT_ID',
+        help='only process this account (can be repeated)',
+    )
+    run_parser.add_argument(
+        '--profile',
+        metavar='DIR',
+        help='write per-stage pstats and memory reports to DIR '
+             '(memory peaks only of stages not overlapping other '
+             'threads)',
+    )
+    run_parser.add_argument(
+        '--flamegraph',
+        action='store_true',
+        help='also write sampled collapsed stacks (with --profile)',
+    )
 
-if __name__ == '__main__':
-    db = DbClient(TYPE, NAME, HOST, PORT, USER, PASSWORD)
-   
-    try:
-        credentials = db.get_credentials(mp_id=1)
-    except (
-        sqlalchemy.exc.OperationalError,
-        sqlalchemy.exc.InternalError,
-        sqlalchemy.exc.ProgrammingError,
-    ) as error:
-        write_event_log(error, 'DbClient.get_credentials')
-        raise error
+    enqueue_parser = commands.add_parser(
+        'enqueue',
+        help='fill the DB job queue with accounts for the workers',
+    )
+    enqueue_parser.set_defaults(handler=enqueue)
+    enqueue_parser.add_argument(
+        '--account',
+        action='append',
+        metavar='CLIENT_ID',
+        help='only enqueue this account (can be repeated)',
+    )
 
-    for _entry in credentials:
-        ozon = OzonApi(_entry['client_id'], _entry['api_key'])
-
-        # Collect client's product ids:
-        product_ids = collect_product_ids(ozon)
-        try: 
-            assert product_ids
-        except AssertionError:
-            write_event_log(
-                f"'product_ids' is empty",
-                'collect_product_ids',
-            )
-            continue
-        
-        # Collect the attributes of the client's products:
-        products_with_attributes = collect_products_attributes(
-            ozon, 
-            product_ids,
-        )
-        try:
-            assert products_with_attributes
-        except AssertionError:
-            write_event_log(
-                f"'products_with_attributes' is empty",
-                'collect_products_attributes',
-            )
-            continue
-
-        # Record categories and attributes of the client's products:
-        category_ids = set()
-        named_attribute_ids = []
-
-        db_session = db.start_session()
-        for _product in products_with_attributes:
-            db_session = add_product_attribute_records(
-                ozon,
-                db,
-                db_session,
-                _product,
-            )
-
-            try:
-                assert _product['category_id'] != 0
-            except AssertionError:
-                write_event_log(
-                    f'Product {_product["id"]} has category_id == 0',
-                    'category_ids.add'
-                )
-            if _product['category_id'] != 0:
-                try:
-                    category_ids.add(_product['category_id'])
-                except KeyError as error:
-                    write_event_log(error, 'category_ids.add')
-                
-        try:
-            db_session.commit()
-        except (
-            sqlalchemy.exc.InternalError,
-            sqlalchemy.exc.IntegrityError,
-            sqlalchemy.exc.ProgrammingError,
-            sqlalchemy.exc.DataError,
-            sqlalchemy.exc.OperationalError,
-        ) as error:
-            write_event_log(error, 'products_with_attributes.commit')
-        
-        try:
-            for _named_attribute_id in products_with_attributes[0]:
-                if _named_attribute_id not in ('id', 'attributes', 'last_id'):
-                    named_attribute_ids.append(_named_attribute_id)
-        except TypeError as error:
-            write_event_log(error, 'named_attribute_ids.append')
-        
-        #Remove duplicates
-        try:
-            db.remove_duplicates(ProductAttributes.__tablename__, 'db_i')
-        except (
-            sqlalchemy.exc.InternalError,
-            sqlalchemy.exc.IntegrityError,
-            sqlalchemy.exc.ProgrammingError,
-            sqlalchemy.exc.DataError,
-            sqlalchemy.exc.OperationalError,
-        ) as error:
-            write_event_log(
-                error,
-                'add_product_attribute_records db.remove_duplicates',
-            )
-        # End of processing client's products
-
-        try:
-            assert category_ids
-        except AssertionError:
-            write_event_log(
-                f"'category_ids' is empty",
-                'add_product_attribute_records',
-            )
-            continue
-
-        # Record the received categories and their attributes
-        db_session = db.start_session()
-        db_session = add_category_records(ozon, db, category_ids, db_session)
-        db_session, dictionary_attributes = add_category_attribute_records(
-            ozon,
-            db,
-            category_ids,
-            named_attribute_ids,
-            db_session,
-        )
-
-        try:
-            db_session.commit()
-        except (
-            sqlalchemy.exc.InternalError,
-            sqlalchemy.exc.IntegrityError,
-            sqlalchemy.exc.ProgrammingError,
-            sqlalchemy.exc.DataError,
-            sqlalchemy.exc.OperationalError,
-        ) as error:
-            write_event_log(error, 'categories.commit')
-
-        #Remove duplicates
-        for table_name, partition in (
-            (Category.__tablename__, 'cat_id'),
-            (CategoryAttributes.__tablename__, 'db_i'),
-        ):
-            try:
-                db.remove_duplicates(table_name, partition)
-            except (
-                sqlalchemy.exc.InternalError,
-                sqlalchemy.exc.IntegrityError,
-                sqlalchemy.exc.ProgrammingError,
-                sqlalchemy.exc.DataError,
-                sqlalchemy.exc.OperationalError,
-            ) as error:
-                write_event_log(
-                    error,
-                    'add_category_attribute_records db.remove_duplicates',
-                )
-
-        try:
-            assert dictionary_attributes
-        except AssertionError:
-            write_event_log(
-                f"'dictionary_attributes' is empty",
-                'add_category_attribute_records',
-            )
-            continue
-
-        # # Record dictionary attribute values (long procces)
-        for _category in dictionary_attributes:
-            for _attribute in dictionary_attributes[_category]:
-                add_dictionary_attribute_value_records(
-                    ozon,
-                    db,
-                    _category,
-                    _attribute,
-                )
+    worker_parser = commands.add_parser(
+        'worker',
+        parents=[stage_options],
+        help='run jobs from the DB job queue',
+    )
+    worker_parser.set_defaults(handler=work)
+    worker_parser.add_argument(
+        '--worker-id',
+        help='name of the worker in the queue (default: host:pid)',
+    )
+    worker_parser.add_argument(
+        '--lease',
+        type=int,
+        default=300,
+        metavar='SECONDS',
+        help='jobs of a worker that stops heartbeating are retried '
+             'after this time',
+    )
+    worker_parser.add_argument(
+        '--max-attempts',
+        type=int,
+        default=3,
+    )
+    worker_parser.add_argument(
+        '--exit-when-idle',
+        action='store_true',
+        help='stop when no job can be claimed instead of polling',
+    )
+
+    jobs_parser = commands.add_parser('jobs', help='show the job queue')
+    jobs_parser.set_defaults(handler=show_jobs)
+
+    refresh_parser = commands.add_parser(
+        'refresh-view',
+        help='create or refresh the product view used by export',
+    )
+    refresh_parser.set_defaults(handler=refresh_view)
+
+    export_parser = commands.add_parser(
+        'export',
+        help='write products with resolved attributes as JSON lines',
+    )
+    export_parser.set_defaults(handler=export)
+    export_parser.add_argument('--account', metavar='CLIENT_ID')
+    export_parser.add_argument(
+        '--product',
+        action='append',
+        metavar='PRODUCT_ID',
+        help='only export this product (can be repeated)',
+    )
+    export_parser.add_argument(
+        '--products-file',
+        metavar='PATH',
+        help='file with product ids to export, one per line',
+    )
+    export_parser.add_argument(
+        '--output',
+        metavar='PATH',
+        help='default: standard output',
+    )
+    export_parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='rows fetched from the DB at once',
+    )
+
+    stats_parser = commands.add_parser(
+        'recording-stats',
+        help='show request latencies of a recording',
+    )
+    stats_parser.set_defaults(handler=recording_stats)
+    stats_parser.add_argument('path', metavar='PATH')
+
+    config_parser = commands.add_parser(
+        'config',
+        help='show the effective settings',
+    )
+    config_parser.set_defaults(handler=show_config)
+
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+    if args.command is None:
+        # Without a command the full pipeline is run, as before:
+        args = parser.parse_args([*argv, 'run'])
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.handler(args, load_config(args.config))
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, Text, String, ForeignKey
+from sqlalchemy import (Column, Integer, Text, String, ForeignKey, DateTime,
+                        LargeBinary)
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -24,15 +25,24 @@ class Category(Base):
     cat_id = Column(String, nullable=False)
     mp_id = Column(Integer, ForeignKey(Marketplace.id))
 
+class ValueBlob(Base):
+    __tablename__ = 'value_blob'
+    hash = Column(String, primary_key=True)  # SHA-256 of the UTF-8 value
+    compression = Column(String)  # 'zstd' or None
+    size = Column(Integer)  # Uncompressed size in bytes
+    data = Column(LargeBinary)
+
 class ProductAttributes(Base):
     __tablename__ = 'product_attr'
     id = Column(Integer, primary_key=True, autoincrement=True)
     product_id = Column(String)
     attribute_id = Column(String)
     value = Column(Text)    
+    value_hash = Column(String, ForeignKey('value_blob.hash'))  # Large value
     dictionary_value_id = Column(String)
     complex_id = Column(String)
     mp_id = Column(Integer, ForeignKey(Marketplace.id))
+    account_id = Column(String, index=True)  # Seller account Client-Id
     db_i = Column(String)  # Index: combined product ID and attribute ID value
 
 class CategoryAttributes(Base):
@@ -58,3 +68,17 @@ class AttributeDictionaryValue(Base):
     info = Column(String)
     attr_param_id = Column(String)  # Dictionary value ID
     db_i = Column(String)  # Index: combined attribute ID and dictionary value ID value
+
+class Job(Base):
+    __tablename__ = 'job_queue'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String, nullable=False)  # 'account' or 'dictionary'
+    key = Column(String, nullable=False, unique=True)  # Unit of work
+    payload = Column(Text)  # JSON
+    status = Column(String, nullable=False, default='pending', index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    worker_id = Column(String)  # Worker holding the lease
+    # Compared with the DB's now(), so independent of session time zones:
+    lease_expires_at = Column(DateTime(timezone=True))
+    progress = Column(Text)
+    error = Column(Text)
@@ -1,10 +1,14 @@
-import requests
 import json
+from transport import HttpTransport
 
 
 class OzonApi():
-    def __init__(self, client_id, api_key):
+    """Ozon Seller API client. Requests are sent by the 'transport'
+    (over the network by default), which can also record or replay them.
+    """
+    def __init__(self, client_id, api_key, transport=None):
         self.api_url = 'https://api-seller.ozon.ru'
+        self.transport = transport or HttpTransport()
         self.headers = {
             'Content-Type': 'application/json',
             'Client-Id': f'{client_id}',
@@ -20,18 +24,14 @@ class OzonApi():
             'last_id': last_id,
             'limit': limit,
         }
-        return requests.post(
-            url=_url,
-            headers=self.headers,
-            data=json.dumps(_data),
-        )
+        return self._post(_url, _data)
 
     def product_attributes(self, product_ids:list, last_id='', limit=1000):
         """Returns a list of dictionaries with with product attributes.
         Even though it is suggested to use 'last_id' for
         iterating over large lists, method of application is not clear.
-        For this reason, the use of lists longer than 50 values
-        is not recommended.
+        For this reason, 'product_ids' should not be longer than 'limit'
+        (1000 at most).
         """
         if (hasattr(product_ids, '__iter__') and
             not isinstance(product_ids, str)):
@@ -48,11 +48,7 @@ class OzonApi():
             'last_id': last_id,
             'limit': limit,
         }
-        return requests.post(
-            url=_url,
-            headers=self.headers,
-            data=json.dumps(_data),
-        )
+        return self._post(_url, _data)
 
     def product_description(self, product_id:int):
         """Returns a dictionary containing product description.
@@ -61,11 +57,7 @@ class OzonApi():
         _data = {
             'product_id': product_id,
         }
-        return requests.post(
-            url=_url,
-            headers=self.headers,
-            data=json.dumps(_data),
-        ) 
+        return self._post(_url, _data)
 
     def category_info(self, category_id:int=None, language='RU'):
         """Returns the category name and subcategories.
@@ -76,11 +68,7 @@ class OzonApi():
             'category_id': category_id,
             'language': language,
         }
-        return requests.post(
-            url=_url,
-            headers=self.headers,
-            data=json.dumps(_data),
-        )
+        return self._post(_url, _data)
 
     def category_attributes(self, category_ids:list,
                             attribute_type='ALL', language='RU'):
@@ -99,11 +87,7 @@ class OzonApi():
             'category_id': _category_ids,
             'language': language,
         }
-        return requests.post(
-            url=_url,
-            headers=self.headers,
-            data=json.dumps(_data),
-        )
+        return self._post(_url, _data)
 
     def attribute_dictionary_values(self, category_id:int, attribute_id:int,
                            last_value_id:int=None, limit=5000, language='RU'):
@@ -118,8 +102,7 @@ class OzonApi():
             'language': language,
             'limit': limit,
         }
-        return requests.post(
-            url=_url,
-            headers=self.headers,
-            data=json.dumps(_data),
-        )
+        return self._post(_url, _data)
+
+    def _post(self, url:str, data:dict):
+        return self.transport.post(url, self.headers, json.dumps(data))
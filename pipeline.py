@@ -0,0 +1,908 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import sqlalchemy
+from db_client import DbClient
+from batching import AdaptiveBatcher, RejectedIds, TransientError
+from db_writer import DbWriter
+from models import (ProductAttributes, Category, CategoryAttributes,
+                       AttributeDictionaryValue)
+from ozon_api import OzonApi
+from profiling import NullProfiler
+from utils import write_event_log
+
+
+# API request chunk sizes (adjusted at runtime by AdaptiveBatcher):
+PRODUCT_BATCH_SIZE = 50
+PRODUCT_BATCH_MAX_SIZE = 1000  # Documented 'product_attributes' limit
+CATEGORY_BATCH_SIZE = 20  # Documented 'category_attributes' limit
+
+
+class AccountError(Exception):
+    """The API refuses the account's requests (e.g. its Api-key
+    was revoked), so the account is not processed further.
+    """
+
+
+def raise_transient(response:requests.Response):
+    """Raises TransientError if the request may succeed when retried
+    (rate limiting or a server error).
+    """
+    if response.status_code == 429 or response.status_code >= 500:
+        retry_after = response.headers.get('Retry-After', '')
+        raise TransientError(
+            f'{response.status_code} {response.reason} for {response.url}',
+            float(retry_after) if retry_after.isdigit() else None,
+        )
+
+def raise_batch_error(response:requests.Response, chunk:list,
+                      id_field:str):
+    """Raises the AdaptiveBatcher error matching a failed response
+    to a request of the 'chunk' ids passed as 'id_field'.
+    Only client errors naming some of the ids or the 'id_field'
+    are treated as rejected ids.
+    """
+    raise_transient(response)
+    if response.status_code in (401, 403):
+        raise AccountError(
+            f'{response.status_code} {response.reason} for {response.url}'
+        )
+    if not 400 <= response.status_code < 500:
+        return
+    # The error's numeric 'code' must not be taken for an id:
+    try:
+        body = response.json()
+        text = f"{body.get('message')} {body.get('details')}"
+    except (ValueError, AttributeError):
+        text = response.text
+    named = [_id for _id in chunk
+             if re.search(rf'\b{re.escape(str(_id))}\b', text)]
+    if named and len(named) < len(chunk):
+        raise RejectedIds(text, named)
+    if named or id_field in text:
+        raise RejectedIds(text)
+
+def collect_product_ids(ozon:OzonApi, product_ids:list=None, 
+                        last_id:str='')->list:
+    """Returns a list of client's product ids.
+    Iterates over large lists of products with recursive self-calls.
+    """
+    product_ids = product_ids or []
+    try:
+        response = ozon.product_list(last_id=last_id)
+    except requests.exceptions.ConnectionError as error:
+        write_event_log(error, 'ozon.product_list')
+        return product_ids
+
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as error:
+        write_event_log(error, 'collect_product_ids', response.json())
+        return product_ids
+
+    try:
+        result = response.json()['result']
+    except KeyError as error:
+        write_event_log(error, 'collect_product_ids', response.json())
+        return product_ids
+
+    try:
+        products = result['items']
+    except KeyError as error:
+        write_event_log(error, 'collect_product_ids', response.json())
+        return product_ids
+    
+    try:
+        assert isinstance(products, list)
+    except AssertionError:
+        write_event_log(
+            f'{type(products)} is not "list" object',
+            'collect_product_ids',
+        )
+        return product_ids
+
+    if products:
+        for _entry in products:
+            try:
+                product_ids.append(_entry['product_id'])
+            except KeyError as error:                
+                write_event_log(error, 'collect_product_ids', response.json())
+                return product_ids
+        try:        
+            return collect_product_ids(ozon, product_ids, result['last_id'])
+        except KeyError as error:
+            write_event_log(error, 'collect_product_ids', response.json())
+            return product_ids
+    else:
+        return product_ids
+
+def collect_products_attributes(ozon:OzonApi, product_ids:list,
+                                batcher:AdaptiveBatcher=None)->list:
+    """Returns a list of attributes of the client's products.
+    Products are requested in chunks sized by the 'batcher'.
+    """
+    _product_ids = (product_ids if isinstance(product_ids, list) 
+                else [product_ids])
+    batcher = batcher or AdaptiveBatcher(
+        PRODUCT_BATCH_SIZE,
+        max_size=PRODUCT_BATCH_MAX_SIZE,
+    )
+
+    def fetch(chunk:list):
+        try:
+            response = ozon.product_attributes(chunk)
+        except requests.exceptions.ConnectionError as error:
+            write_event_log(error, 'ozon.product_attributes')
+            raise TransientError(error)
+
+        raise_batch_error(response, chunk, 'product_id')
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            write_event_log(
+                error,
+                'collect_products_attributes',
+                response.json(),
+            )
+            return None, len(response.content)
+
+        try:
+            result = response.json()['result']
+        except KeyError as error:
+            write_event_log(
+                error,
+                'collect_products_attributes',
+                response.json(),
+            )
+            return None, len(response.content)
+
+        try:
+            assert isinstance(result, list)
+        except AssertionError:
+            write_event_log(
+                f'{type(result)} is not "list" object',
+                'collect_products_attributes',
+            )
+            return None, len(response.content)
+
+        return result, len(response.content)
+
+    return batcher.process(_product_ids, fetch)
+
+def add_product_attribute_records(ozon:OzonApi, db:DbClient,
+                                  db_session, product:dict, account_id:str):
+    """Gets the product description. Returns a DB session with
+    created product attributes and description records
+    of the seller account ('account_id').
+    """
+    # Get product description:
+    product_description = None
+    try:
+        response = ozon.product_description(product.get('id'))
+    except requests.exceptions.ConnectionError as error:
+        write_event_log(error, 'ozon.product_description')
+        response = None
+
+    if response is not None:
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            write_event_log(
+                error,
+                'add_product_attribute_records',
+                response.json(),
+            )
+
+        try:
+            product_description = response.json()['result']['description']
+        except KeyError as error:
+            write_event_log(
+                error,
+                'add_product_attribute_records',
+                response.json(),
+            )
+            product_description = None
+
+    if product_description:
+        try:
+            db_session = db.add_record(
+                db_session=db_session,
+                model=ProductAttributes,
+                product_id=product['id'],
+                attribute_id='description',
+                value=product_description, 
+                mp_id=1,
+                account_id=account_id,
+                db_i=f"{product['id']}description",
+            )
+        except KeyError as error:
+            write_event_log(
+                error,
+                'add_product_attribute_records',
+            )
+
+    # Get product attributes:
+    LIST_ATTRIBUTES = (
+        'images',
+        'images360',
+        'pdf_list',
+        'complex_attributes',
+    )
+    try:
+        for _key, _value in product.items():
+            if _key in LIST_ATTRIBUTES:
+                value_list = []
+                for _item in _value:
+                    try:
+                        value_list.append(_item['file_name'])
+                    except KeyError as error:
+                        write_event_log(
+                            error,
+                            'add_product_attribute_records',
+                        )
+                _complex_value = '|'.join(value_list) if value_list else None
+                try:    
+                    db_session = db.add_record(
+                        db_session=db_session,
+                        model=ProductAttributes,
+                        product_id=product['id'],
+                        attribute_id=_key,
+                        value=_complex_value, 
+                        mp_id=1,
+                        account_id=account_id,
+                        db_i=f"{product['id']}{_key}",
+                    )
+                except KeyError as error:
+                    write_event_log(
+                        error,
+                        'add_product_attribute_records',
+                    )
+
+            elif _key == 'attributes':
+                for _attribute in _value:
+                    for _item in _attribute.get('values'):
+                        try:
+                            db_session = db.add_record(
+                                db_session=db_session,
+                                model=ProductAttributes,
+                                product_id=product['id'],
+                                attribute_id=_attribute['attribute_id'],
+                                value=_item['value'],
+                                dictionary_value_id=_item[
+                                                'dictionary_value_id'],
+                                complex_id=_attribute['complex_id'], 
+                                mp_id=1,
+                                account_id=account_id,
+                                db_i=(f"{product['id']}"
+                                      f"{_attribute['attribute_id']}"),
+                            )
+                        except KeyError as error:
+                            write_event_log(
+                                error,
+                                'add_product_attribute_records',
+                            )
+
+            elif _key not in ('id', 'last_id'):
+                try:
+                    db_session = db.add_record(
+                        db_session=db_session,
+                        model=ProductAttributes,
+                        product_id=product['id'],
+                        attribute_id=_key,
+                        value=_value,
+                        mp_id=1,
+                        account_id=account_id,
+                        db_i=f"{product['id']}{_key}",
+                    )
+                except KeyError as error:
+                    write_event_log(
+                        error,
+                        'add_product_attribute_records',
+                    )
+    except TypeError as error:
+        write_event_log(
+            error,
+            'add_product_attribute_records',
+        )
+
+    return db_session
+
+def add_category_records(ozon:OzonApi, db:DbClient, category_ids:set,
+                         db_session):
+    """Returns a DB session with created category records.
+    """
+    if (hasattr(category_ids, '__iter__') and
+        not isinstance(category_ids, str)):
+        _category_ids = category_ids
+    else:
+        _category_ids = [category_ids]
+
+    for _category in _category_ids:
+        try:
+            response = ozon.category_info(_category)
+        except requests.exceptions.ConnectionError as error:
+            write_event_log(error, 'ozon.category_info')
+            continue
+
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            write_event_log(error, 'add_category_records', response.json())
+            continue
+
+        try:
+            _category_info = response.json()['result'][0]
+        except (TypeError, KeyError) as error:
+            write_event_log(error, 'add_category_records', response.json())
+            continue
+
+        if _category_info:
+            try:
+                db_session = db.add_record(
+                    db_session=db_session,
+                    model=Category,
+                    name=_category_info['title'],
+                    cat_id=_category_info['category_id'],
+                    mp_id=1,
+                )
+            except KeyError as error:
+                write_event_log(error, 'add_category_records', response.json())
+        
+    return db_session
+
+def add_category_attribute_records(ozon:OzonApi, db:DbClient,
+                    category_ids:set, named_attribute_ids:list, db_session,
+                    batcher:AdaptiveBatcher=None):
+    """Returns a DB session with created category attribute records.
+    Also returns a dictionary with categories and dictionary attributes ids
+    needed to get dictionary values.
+    """
+    dictionary_attributes = dict()
+    if (hasattr(category_ids, '__iter__') and
+        not isinstance(category_ids, str)):
+        _category_ids = list(category_ids)
+    else:
+        _category_ids = [category_ids]
+
+    def fetch(chunk:list):
+        try:
+            response = ozon.category_attributes(chunk)
+        except requests.exceptions.ConnectionError as error:
+            write_event_log(error, 'ozon.category_attributes')
+            raise TransientError(error)
+
+        raise_batch_error(response, chunk, 'category_id')
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            write_event_log(
+                error,
+                'add_category_attribute_records',
+                response.json(),
+            )
+            return None, len(response.content)
+
+        try:
+            return response.json()['result'], len(response.content)
+        except (TypeError, KeyError) as error:
+            write_event_log(error, 'add_category_records', response.json())
+            return None, len(response.content)
+
+    batcher = batcher or AdaptiveBatcher(
+        CATEGORY_BATCH_SIZE,
+        max_size=CATEGORY_BATCH_SIZE,
+    )
+    _category_attributes = batcher.process(_category_ids, fetch)
+
+    for _category in _category_attributes:
+        try:
+            dictionary_attributes[_category['category_id']] = []
+            for _attribute in _category['attributes']:
+                db_session = db.add_record(
+                    db_session=db_session,
+                    model=CategoryAttributes,
+                    chid=_attribute['id'],
+                    name=_attribute['name'],
+                    is_required=_attribute['is_required'],
+                    is_collection=_attribute['is_collection'],
+                    type=_attribute['type'],
+                    description=_attribute['description'],
+                    dictionary_id=_attribute['dictionary_id'],
+                    group_name=_attribute['group_name'],
+                    cat_id=_category['category_id'],
+                    db_i=f"{_category['category_id']}{_attribute['id']}"
+                )
+            
+                if _attribute['dictionary_id'] != 0:
+                    dictionary_attributes[_category['category_id']].append(
+                        _attribute['id']
+                    )
+
+            for _named_attribute in named_attribute_ids:
+                db_session = db.add_record(
+                    db_session=db_session,
+                    model=CategoryAttributes,
+                    chid=_named_attribute,
+                    name=_named_attribute,
+                    is_required=True,
+                    is_collection=False,
+                    type='',
+                    description=_named_attribute,
+                    dictionary_id=None,
+                    group_name=None,
+                    cat_id=_category['category_id'],
+                    db_i=f"{_category['category_id']}{_named_attribute}"
+                )
+        except (TypeError, KeyError) as error:
+            write_event_log(
+                error,
+                'add_category_records',
+            )
+
+    return db_session, dictionary_attributes
+
+def add_dictionary_attribute_value_records(ozon:OzonApi, db:DbClient,
+                        db_session, category_id, attribute_id,
+                        last_value_id:int=None):
+    """Returns a DB session with created records
+    of the attribute's dictionary values.
+    """
+    try:
+        response = ozon.attribute_dictionary_values(
+            category_id,
+            attribute_id,
+            last_value_id,
+        )
+    except requests.exceptions.ConnectionError as error:
+        write_event_log(error, 'ozon.attribute_dictionary_values')
+        return db_session
+
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as error:
+        write_event_log(
+            error,
+            'add_dictionary_attribute_value_records',
+            response.json(),
+        )
+        return db_session
+
+    try:
+        _dictionary_values = response.json()['result']
+    except KeyError as error:
+        write_event_log(
+            error,
+            'add_dictionary_attribute_value_records',
+            response.json(),
+        )
+        return db_session
+
+    if _dictionary_values:
+        for _value in _dictionary_values:
+            try:
+                db_session = db.add_record(
+                    db_session=db_session,
+                    model=AttributeDictionaryValue,
+                    value=_value['value'],
+                    picture=_value['picture'],
+                    info=_value['info'],
+                    attr_param_id=_value['id'],
+                    chid=attribute_id,
+                    db_i=f"{attribute_id}{_value['id']}"
+                )
+            except KeyError as error:
+                write_event_log(
+                    error,
+                    'add_dictionary_attribute_value_records',
+                )
+
+    try:
+        if response.json()['has_next']:
+            db_session = add_dictionary_attribute_value_records(
+                ozon,
+                db,
+                db_session,
+                category_id,
+                attribute_id,
+                _value['id'],
+            )
+    except KeyError as error:
+        write_event_log(
+            error,
+            "'add_dictionary_attribute_value_records' recursive self-call",
+            response.json(),
+        )
+
+    return db_session
+
+
+class Pipeline():
+    """Runs the selected stages for seller accounts.
+    Stages missing from 'stages' are skipped; the data they would have
+    provided to later stages (category ids, named attributes, dictionary
+    attributes) is then read from the DB.
+    'category_ids' limits the category stages to these categories.
+    'on_progress(account_id, stage)' is called after each finished stage.
+    API requests are sent by the OzonApi 'transport'. Recorded runs must
+    use fixed batch sizes ('adaptive_batching' off) to be replayable.
+    Failed requests are retried 'retries' times; replayed failures
+    would fail again, so replays should not retry.
+    Accounts may be processed from several threads at once.
+    """
+    def __init__(self, db:DbClient, db_writer:DbWriter, stages,
+                 category_ids:set=None, refresh_mode='upsert', workers=1,
+                 profiler=None, on_progress=None, transport=None,
+                 adaptive_batching=True, retries=3):
+        self.db = db
+        self.db_writer = db_writer
+        self.stages = set(stages)
+        self.category_ids = category_ids
+        self.refresh_mode = refresh_mode
+        self.workers = workers
+        self.profiler = profiler or NullProfiler()
+        self.on_progress = on_progress or (lambda account_id, stage: None)
+        self.transport = transport
+        # Chunk sizes tuned for one account are reused for the next ones:
+        self.product_batcher = AdaptiveBatcher(
+            PRODUCT_BATCH_SIZE,
+            min_size=(1 if adaptive_batching else PRODUCT_BATCH_SIZE),
+            max_size=(PRODUCT_BATCH_MAX_SIZE if adaptive_batching
+                      else PRODUCT_BATCH_SIZE),
+            retries=retries,
+        )
+        self.category_batcher = AdaptiveBatcher(
+            CATEGORY_BATCH_SIZE,
+            min_size=(1 if adaptive_batching else CATEGORY_BATCH_SIZE),
+            max_size=CATEGORY_BATCH_SIZE,
+            retries=retries,
+        )
+        # Dictionaries are shared by accounts, so each is harvested once:
+        self._dictionary_pairs = set()
+        self._dictionary_lock = threading.Lock()
+        # Pool shared by the accounts' dictionaries during 'run':
+        self._dictionary_executor = None
+
+    def run(self, credentials:list):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, \
+             ThreadPoolExecutor(max_workers=self.workers) as dictionaries:
+            self._dictionary_executor = dictionaries
+            list(executor.map(self._try_process_account, credentials))
+        self._dictionary_executor = None
+
+        # Throughput per chunk size, for tuning the batch settings:
+        write_event_log(
+            self.product_batcher.report(),
+            'product_attributes batches',
+        )
+        write_event_log(
+            self.category_batcher.report(),
+            'category_attributes batches',
+        )
+
+    def process_account(self, credentials:dict)->dict:
+        """Runs the stages for the account. Returns a dictionary with
+        categories and their dictionary attribute ids (None if the
+        category stages did not run). Errors of records that could not
+        be written are raised.
+        """
+        account_id = credentials['client_id']
+        ozon = OzonApi(account_id, credentials['api_key'], self.transport)
+        category_ids = None
+        named_attribute_ids = None
+        dictionary_attributes = None
+
+        if 'products' in self.stages:
+            products = self.record_products(ozon, account_id)
+            if products is None:
+                return None
+            category_ids, named_attribute_ids = products
+            self.on_progress(account_id, 'products')
+
+        if not self.stages & {'categories', 'category-attributes',
+                              'dictionaries'}:
+            return None
+
+        category_ids = self.select_category_ids(account_id, category_ids)
+        try:
+            assert category_ids
+        except AssertionError:
+            write_event_log(
+                f"'category_ids' is empty",
+                'Pipeline.process_account',
+            )
+            return None
+
+        if 'categories' in self.stages:
+            self.record_categories(ozon, category_ids)
+            self.on_progress(account_id, 'categories')
+
+        if 'category-attributes' in self.stages:
+            if named_attribute_ids is None:
+                named_attribute_ids = self._read_from_db(
+                    self.db.get_named_attribute_ids,
+                    account_id,
+                )
+            dictionary_attributes = self.record_category_attributes(
+                ozon,
+                category_ids,
+                named_attribute_ids,
+            )
+            self.on_progress(account_id, 'category-attributes')
+
+        if 'dictionaries' in self.stages:
+            if dictionary_attributes is None:
+                dictionary_attributes = self._read_from_db(
+                    self.db.get_dictionary_attributes,
+                    category_ids,
+                )
+            try:
+                assert dictionary_attributes
+            except AssertionError:
+                write_event_log(
+                    f"'dictionary_attributes' is empty",
+                    'add_category_attribute_records',
+                )
+                return dictionary_attributes
+            self.record_dictionaries(ozon, dictionary_attributes)
+            self.on_progress(account_id, 'dictionaries')
+
+        return dictionary_attributes
+
+    def select_category_ids(self, account_id:str,
+                            category_ids:set=None)->set:
+        """Returns the account's category ids (read from the DB if
+        not passed) limited to the pipeline's 'category_ids'.
+        """
+        if category_ids is None:
+            category_ids = self._read_from_db(
+                self.db.get_category_ids,
+                account_id,
+            )
+        if self.category_ids:
+            category_ids = category_ids & self.category_ids
+        return category_ids
+
+    def _try_process_account(self, credentials:dict)->dict:
+        """Keeps the other accounts running if the account's records
+        could not be written or its requests are refused.
+        """
+        try:
+            return self.process_account(credentials)
+        except AccountError as error:
+            write_event_log(
+                error,
+                f"Pipeline.process_account {credentials['client_id']}",
+            )
+            return None
+        except (
+            sqlalchemy.exc.InternalError,
+            sqlalchemy.exc.IntegrityError,
+            sqlalchemy.exc.ProgrammingError,
+            sqlalchemy.exc.DataError,
+            sqlalchemy.exc.OperationalError,
+            sqlalchemy.exc.TimeoutError,  # No free pooled connection
+        ) as error:
+            write_event_log(
+                error,
+                f"Pipeline.process_account {credentials['client_id']}",
+            )
+            return None
+
+    def record_products(self, ozon:OzonApi, account_id:str):
+        """Records the account's product attributes.
+        Returns a set of the products' category ids and a list of
+        named attribute ids or None if there are no products.
+        """
+        # Collect client's product ids:
+        with self.profiler.stage('collect_product_ids'):
+            product_ids = collect_product_ids(ozon)
+        try: 
+            assert product_ids
+        except AssertionError:
+            write_event_log(
+                f"'product_ids' is empty",
+                'collect_product_ids',
+            )
+            return None
+        
+        # Collect the attributes of the client's products:
+        with self.profiler.stage('collect_products_attributes'):
+            products_with_attributes = collect_products_attributes(
+                ozon, 
+                product_ids,
+                self.product_batcher,
+            )
+        try:
+            assert products_with_attributes
+        except AssertionError:
+            write_event_log(
+                f"'products_with_attributes' is empty",
+                'collect_products_attributes',
+            )
+            return None
+
+        # Record categories and attributes of the client's products:
+        category_ids = set()
+        named_attribute_ids = []
+
+        # In 'replace' mode the old records are only deleted
+        # if all of the new ones are written:
+        db_session = self.db_writer.session(
+            atomic=self.refresh_mode == 'replace',
+        )
+        if self.refresh_mode == 'replace':
+            db_session.execute(
+                lambda _db_session: self.db.remove_account_records(
+                    _db_session,
+                    ProductAttributes,
+                    account_id,
+                )
+            )
+        for _product in products_with_attributes:
+            with self.profiler.stage('add_product_attribute_records'):
+                add_product_attribute_records(
+                    ozon,
+                    self.db,
+                    db_session,
+                    _product,
+                    account_id,
+                )
+
+            try:
+                assert _product['category_id'] != 0
+            except AssertionError:
+                write_event_log(
+                    f'Product {_product["id"]} has category_id == 0',
+                    'category_ids.add'
+                )
+            if _product['category_id'] != 0:
+                try:
+                    category_ids.add(_product['category_id'])
+                except KeyError as error:
+                    write_event_log(error, 'category_ids.add')
+                
+        # Wait for the account's records to be written:
+        with self.profiler.stage('db_writer.commit'):
+            db_session.commit()
+
+        try:
+            for _named_attribute_id in products_with_attributes[0]:
+                if _named_attribute_id not in ('id', 'attributes', 'last_id'):
+                    named_attribute_ids.append(_named_attribute_id)
+        except TypeError as error:
+            write_event_log(error, 'named_attribute_ids.append')
+        
+        self._remove_duplicates(
+            ProductAttributes.__tablename__,
+            'db_i',
+            account_id,
+        )
+        self._remove_legacy_records(account_id)
+        return category_ids, named_attribute_ids
+
+    def record_categories(self, ozon:OzonApi, category_ids:set):
+        db_session = self.db_writer.session()
+        with self.profiler.stage('add_category_records'):
+            add_category_records(ozon, self.db, category_ids, db_session)
+        with self.profiler.stage('db_writer.commit'):
+            db_session.commit()
+        self._remove_duplicates(Category.__tablename__, 'cat_id')
+
+    def record_category_attributes(self, ozon:OzonApi, category_ids:set,
+                                   named_attribute_ids:list)->dict:
+        """Records the categories' attributes. Returns a dictionary
+        with categories and their dictionary attribute ids.
+        """
+        db_session = self.db_writer.session()
+        with self.profiler.stage('add_category_attribute_records'):
+            _, dictionary_attributes = add_category_attribute_records(
+                ozon,
+                self.db,
+                category_ids,
+                named_attribute_ids,
+                db_session,
+                self.category_batcher,
+            )
+        with self.profiler.stage('db_writer.commit'):
+            db_session.commit()
+        self._remove_duplicates(CategoryAttributes.__tablename__, 'db_i')
+        return dictionary_attributes
+
+    def record_dictionaries(self, ozon:OzonApi, dictionary_attributes:dict):
+        """Records dictionary attribute values (long procces).
+        During 'run' the dictionaries of all accounts share one pool
+        of 'workers' threads.
+        """
+        pairs = []
+        with self._dictionary_lock:
+            for _category in dictionary_attributes:
+                for _attribute in dictionary_attributes[_category]:
+                    if (_category, _attribute) not in self._dictionary_pairs:
+                        self._dictionary_pairs.add((_category, _attribute))
+                        pairs.append((_category, _attribute))
+
+        db_session = self.db_writer.session()
+
+        def record(pair):
+            with self.profiler.stage('add_dictionary_attribute_value_records'):
+                add_dictionary_attribute_value_records(
+                    ozon,
+                    self.db,
+                    db_session,
+                    *pair,
+                )
+
+        if self._dictionary_executor is None:
+            list(map(record, pairs))
+        else:
+            list(self._dictionary_executor.map(record, pairs))
+        with self.profiler.stage('db_writer.commit'):
+            db_session.commit()
+        self._remove_duplicates(AttributeDictionaryValue.__tablename__, 'db_i')
+
+    def record_dictionary(self, ozon:OzonApi, category_id, attribute_id):
+        """Records values of a single attribute dictionary.
+        Only the attribute's duplicates are removed.
+        """
+        db_session = self.db_writer.session()
+        with self.profiler.stage('add_dictionary_attribute_value_records'):
+            add_dictionary_attribute_value_records(
+                ozon,
+                self.db,
+                db_session,
+                category_id,
+                attribute_id,
+            )
+        with self.profiler.stage('db_writer.commit'):
+            db_session.commit()
+        self._remove_duplicates(
+            AttributeDictionaryValue.__tablename__,
+            'db_i',
+            chid=attribute_id,
+        )
+
+    def _remove_duplicates(self, table, partition, account_id=None,
+                           **filters):
+        try:
+            with self.profiler.stage('remove_duplicates'):
+                self.db.remove_duplicates(
+                    table,
+                    partition,
+                    account_id,
+                    **filters,
+                )
+        except (
+            sqlalchemy.exc.InternalError,
+            sqlalchemy.exc.IntegrityError,
+            sqlalchemy.exc.ProgrammingError,
+            sqlalchemy.exc.DataError,
+            sqlalchemy.exc.OperationalError,
+            sqlalchemy.exc.TimeoutError,  # No free pooled connection
+        ) as error:
+            write_event_log(error, f'{table} db.remove_duplicates')
+
+    def _remove_legacy_records(self, account_id):
+        try:
+            with self.profiler.stage('remove_legacy_records'):
+                self.db.remove_legacy_records(ProductAttributes, account_id)
+        except (
+            sqlalchemy.exc.InternalError,
+            sqlalchemy.exc.IntegrityError,
+            sqlalchemy.exc.ProgrammingError,
+            sqlalchemy.exc.DataError,
+            sqlalchemy.exc.OperationalError,
+            sqlalchemy.exc.TimeoutError,  # No free pooled connection
+        ) as error:
+            write_event_log(error, 'db.remove_legacy_records')
+
+    def _read_from_db(self, method, *args):
+        try:
+            return method(*args)
+        except (
+            sqlalchemy.exc.OperationalError,
+            sqlalchemy.exc.InternalError,
+            sqlalchemy.exc.ProgrammingError,
+        ) as error:
+            write_event_log(error, f'DbClient.{method.__name__}')
+            raise error
@@ -0,0 +1,169 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StageProfiler():
+    """Profiles named stages of a run, from any number of threads.
+    Each stage gets cProfile statistics of all the threads running it
+    and the peak of memory allocated while it runs. Memory is traced
+    for the whole process, so peaks are only measured for calls that
+    did not overlap stages of other threads.
+    With 'flamegraph' the stages' call stacks are sampled every
+    'interval' seconds into collapsed-stack files.
+    Nested stages are accounted to the outer one.
+    Reports are written to 'output_dir' by 'close'.
+    """
+    def __init__(self, output_dir:str, flamegraph=False, interval=0.005):
+        self.output_dir = output_dir
+        self.interval = interval
+        # Stage: [calls, seconds, [cProfile.Profile], peak bytes,
+        #         top lines, calls with measured memory]
+        self.stages = dict()
+        # Stage: {collapsed stack: samples}
+        self.stacks = dict()
+        # Thread id: stage it is running
+        self._active = dict()
+        # Threads whose current stage overlapped another thread's stage:
+        self._overlapped = set()
+        self._lock = threading.Lock()
+        # Profile of each stage in the current thread:
+        self._local = threading.local()
+        tracemalloc.start()
+        self._sampler = None
+        if flamegraph:
+            self._running = True
+            self._sampler = threading.Thread(
+                target=self._sample,
+                name='StageProfiler',
+                daemon=True,
+            )
+            self._sampler.start()
+
+    @contextmanager
+    def stage(self, name:str):
+        thread_id = threading.get_ident()
+        with self._lock:
+            if thread_id in self._active:
+                nested = True
+            else:
+                nested = False
+                _stage = self.stages.setdefault(
+                    name,
+                    [0, 0.0, [], 0, [], 0],
+                )
+                if self._active:
+                    self._overlapped.update(self._active)
+                    self._overlapped.add(thread_id)
+                else:
+                    tracemalloc.reset_peak()
+                    _memory_start = tracemalloc.get_traced_memory()[0]
+                self._active[thread_id] = name
+        if nested:
+            yield
+            return
+
+        profiles = getattr(self._local, 'profiles', None)
+        if profiles is None:
+            profiles = self._local.profiles = dict()
+        if name not in profiles:
+            profiles[name] = cProfile.Profile()
+            with self._lock:
+                _stage[2].append(profiles[name])
+        _start = time.perf_counter()
+        profiles[name].enable()
+        try:
+            yield
+        finally:
+            profiles[name].disable()
+            _seconds = time.perf_counter() - _start
+            with self._lock:
+                del self._active[thread_id]
+                _stage[0] += 1
+                _stage[1] += _seconds
+                if thread_id in self._overlapped:
+                    self._overlapped.discard(thread_id)
+                else:
+                    _stage[5] += 1
+                    _peak = tracemalloc.get_traced_memory()[1] - _memory_start
+                    if _peak > _stage[3]:
+                        _stage[3] = _peak
+                        _stage[4] = tracemalloc.take_snapshot().statistics(
+                            'lineno')[:20]
+
+    def _sample(self):
+        while self._running:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+            frames = sys._current_frames()
+            for _thread_id, _stage in active:
+                frame = frames.get(_thread_id)
+                calls = []
+                while frame is not None:
+                    _code = frame.f_code
+                    calls.append(
+                        f'{_code.co_name} '
+                        f'({os.path.basename(_code.co_filename)})'
+                    )
+                    frame = frame.f_back
+                _stack = ';'.join(reversed(calls))
+                _stacks = self.stacks.setdefault(_stage, dict())
+                _stacks[_stack] = _stacks.get(_stack, 0) + 1
+
+    def close(self):
+        """Stops profiling and writes the stage reports.
+        """
+        if self._sampler:
+            self._running = False
+            self._sampler.join()
+        tracemalloc.stop()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        summary = []
+        for _name, (_calls, _seconds, _profiles, _peak, _top,
+                    _measured) in self.stages.items():
+            _path = os.path.join(self.output_dir, _name)
+            # Profiles of the threads are merged into one report:
+            _stats = pstats.Stats(_profiles[0])
+            for _profile in _profiles[1:]:
+                _stats.add(_profile)
+            _stats.dump_stats(f'{_path}.pstats')
+            with open(f'{_path}.memory.txt', 'w', encoding='utf-8') as file:
+                file.write(f'Calls measured: {_measured} of {_calls} '
+                           '(others overlapped other threads)\n')
+                file.write(f'Peak allocated: {_peak / 1024:.1f} KiB\n')
+                file.write('Top allocations at the end of the peak call:\n')
+                for _line in _top:
+                    file.write(f'{_line}\n')
+            _peak_kib = f'{_peak / 1024:.1f}' if _measured else 'n/a'
+            summary.append(
+                f'{_name}: calls={_calls} seconds={_seconds:.3f} '
+                f'peak_kib={_peak_kib}'
+            )
+
+        for _name, _stacks in self.stacks.items():
+            _path = os.path.join(self.output_dir, f'{_name}.collapsed')
+            with open(_path, 'w', encoding='utf-8') as file:
+                for _stack, _samples in _stacks.items():
+                    file.write(f'{_stack} {_samples}\n')
+
+        with open(os.path.join(self.output_dir, 'summary.txt'), 'w',
+                  encoding='utf-8') as file:
+            file.write('\n'.join(summary) + '\n')
+
+
+class NullProfiler():
+    """Used in place of StageProfiler when profiling is off.
+    """
+    @contextmanager
+    def stage(self, name:str):
+        yield
+
+    def close(self):
+        pass
@@ -0,0 +1,152 @@
+import json
+import sqlite3
+import threading
+import zlib
+from http import HTTPStatus
+from urllib.parse import urlsplit
+import requests
+
+
+# Endpoints of data shared by all accounts. Which account requests
+# a dictionary depends on thread timing, so it is not part of the key:
+SHARED_ENDPOINTS = {'/v2/category/attribute/values'}
+
+
+class HttpTransport():
+    """Sends API requests over the network.
+    """
+    def post(self, url:str, headers:dict, data:str):
+        return requests.post(url=url, headers=headers, data=data)
+
+
+class RecordStore():
+    """On-disk SQLite store of API responses keyed by the endpoint,
+    the account (Client-Id, except for SHARED_ENDPOINTS) and
+    the canonicalised JSON request body.
+    Response bodies are zlib-compressed.
+    """
+    def __init__(self, path:str):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    endpoint TEXT,
+                    status INTEGER,
+                    body BLOB,
+                    elapsed REAL
+                )
+            """)
+
+    @staticmethod
+    def make_key(url:str, headers:dict, data:str)->tuple:
+        """Returns the endpoint and the request key.
+        """
+        endpoint = urlsplit(url).path
+        body = json.dumps(
+            json.loads(data),
+            sort_keys=True,
+            separators=(',', ':'),
+            ensure_ascii=False,
+        )
+        client_id = (None if endpoint in SHARED_ENDPOINTS
+                     else headers.get('Client-Id'))
+        return endpoint, f'{endpoint} {client_id} {body}'
+
+    def save(self, key:str, endpoint:str, status:int, body:bytes,
+             elapsed:float):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                (key, endpoint, status, zlib.compress(body), elapsed),
+            )
+
+    def load(self, key:str)->tuple:
+        """Returns the recorded status and body or None.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT status, body FROM responses WHERE key = ?',
+                (key,),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], zlib.decompress(row[1])
+
+    def latency_stats(self)->list:
+        """Returns request count and latency statistics (seconds)
+        for each recorded endpoint.
+        """
+        stats = []
+        with self._lock:
+            endpoints = [_row[0] for _row in self._connection.execute(
+                'SELECT DISTINCT endpoint FROM responses ORDER BY endpoint'
+            )]
+            for _endpoint in endpoints:
+                latencies = [_row[0] for _row in self._connection.execute(
+                    'SELECT elapsed FROM responses WHERE endpoint = ? '
+                    'ORDER BY elapsed',
+                    (_endpoint,),
+                )]
+                stats.append({
+                    'endpoint': _endpoint,
+                    'requests': len(latencies),
+                    'mean': sum(latencies) / len(latencies),
+                    'p50': latencies[len(latencies) // 2],
+                    'p95': latencies[int(len(latencies) * 0.95)],
+                    'max': latencies[-1],
+                    'total': sum(latencies),
+                })
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class RecordingTransport():
+    """Sends requests over the network and records every response.
+    """
+    def __init__(self, store:RecordStore, transport=None):
+        self.store = store
+        self.transport = transport or HttpTransport()
+
+    def post(self, url:str, headers:dict, data:str):
+        response = self.transport.post(url, headers, data)
+        endpoint, key = self.store.make_key(url, headers, data)
+        self.store.save(
+            key,
+            endpoint,
+            response.status_code,
+            response.content,
+            response.elapsed.total_seconds(),
+        )
+        return response
+
+
+class ReplayTransport():
+    """Returns recorded responses without using the network.
+    A request missing from the recording raises ConnectionError,
+    which the pipeline handles like a network failure.
+    """
+    def __init__(self, store:RecordStore):
+        self.store = store
+
+    def post(self, url:str, headers:dict, data:str):
+        _, key = self.store.make_key(url, headers, data)
+        recorded = self.store.load(key)
+        if recorded is None:
+            raise requests.exceptions.ConnectionError(
+                f'No recorded response for {key}'
+            )
+        response = requests.Response()
+        response.status_code, response._content = recorded
+        try:
+            response.reason = HTTPStatus(response.status_code).phrase
+        except ValueError:  # Non-standard status, e.g. 520
+            response.reason = ''
+        response.headers['Content-Type'] = 'application/json'
+        response.encoding = 'utf-8'
+        response.url = url
+        return response
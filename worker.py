@@ -0,0 +1,216 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from db_client import DbClient
+from ozon_api import OzonApi
+from pipeline import Pipeline
+from utils import write_event_log
+
+
+# Lease held by the job of the current worker thread:
+_current = threading.local()
+
+
+class LeaseLost(Exception):
+    """The job's lease expired and the job may be run by another worker.
+    """
+
+
+class JobLease():
+    """Keeps the job's lease alive from a background thread
+    while the job runs. 'progress' is reported with every heartbeat.
+    """
+    def __init__(self, db:DbClient, job_id:int, worker_id:str,
+                 lease_seconds:int):
+        self.db = db
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.progress = None
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._heartbeat,
+            name=f'JobLease-{job_id}',
+            daemon=True,
+        )
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def check(self):
+        """Raises LeaseLost if the job must not be continued.
+        """
+        if self.lost:
+            raise LeaseLost(f'Lease of job {self.job_id} was lost')
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self.lease_seconds / 3):
+            try:
+                held = self.db.heartbeat_job(
+                    self.job_id,
+                    self.worker_id,
+                    self.lease_seconds,
+                    self.progress,
+                )
+            except Exception as error:
+                write_event_log(error, 'JobLease._heartbeat')
+                continue
+            if not held:
+                self.lost = True
+                write_event_log(
+                    f'Lease of job {self.job_id} was lost',
+                    'JobLease._heartbeat',
+                )
+                return
+
+
+def default_worker_id()->str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def report_progress(account_id, stage):
+    """'Pipeline.on_progress' callback for the current job.
+    Stops the job between stages if its lease was lost.
+    """
+    lease = getattr(_current, 'lease', None)
+    if lease is not None:
+        lease.check()
+        lease.progress = f'{account_id}: {stage} recorded'
+
+def enqueue_accounts(db:DbClient, credentials:list):
+    """Starts a new run: removes finished jobs of the previous one
+    and enqueues a job for every account.
+    """
+    db.create_job_table()
+    db.clear_jobs()
+    db.enqueue_jobs('account', {
+        f"account:{_entry['client_id']}": {'client_id': _entry['client_id']}
+        for _entry in credentials
+    })
+
+
+class JobWorker():
+    """Claims and runs jobs from the DB job queue.
+    An account job runs the pipeline's stages except the dictionaries.
+    With 'dictionaries' they are enqueued as separate jobs,
+    one per (category, attribute).
+    API keys are never stored in the queue: they are read from
+    'account_list' by each worker.
+    Jobs whose records could not be written are failed, so they are
+    retried. A job whose lease was lost stops after its current stage.
+    """
+    def __init__(self, db:DbClient, pipeline:Pipeline, worker_id:str,
+                 dictionaries=True, lease_seconds=300, max_attempts=3,
+                 poll_seconds=10, exit_when_idle=False):
+        self.db = db
+        self.pipeline = pipeline
+        self.pipeline.stages.discard('dictionaries')
+        self.dictionaries = dictionaries
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+        self.exit_when_idle = exit_when_idle
+        self._api_keys = dict()
+        self._api_keys_lock = threading.Lock()
+
+    def run(self, threads=1):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(self._loop, range(threads)))
+
+    def _loop(self, thread_number:int):
+        worker_id = f'{self.worker_id}:{thread_number}'
+        while True:
+            job = self.db.claim_job(
+                worker_id,
+                self.lease_seconds,
+                self.max_attempts,
+            )
+            if job is None:
+                if self.exit_when_idle:
+                    return
+                time.sleep(self.poll_seconds)
+                continue
+
+            with JobLease(self.db, job['id'], worker_id,
+                          self.lease_seconds) as lease:
+                _current.lease = lease
+                try:
+                    self._run_job(job)
+                    lease.check()
+                except LeaseLost as error:
+                    # The job belongs to the worker that claimed it again:
+                    write_event_log(error, f"JobWorker job {job['id']}")
+                except Exception as error:
+                    write_event_log(error, f"JobWorker job {job['id']}")
+                    self.db.fail_job(
+                        job['id'],
+                        worker_id,
+                        error,
+                        self.max_attempts,
+                    )
+                else:
+                    if not self.db.complete_job(job['id'], worker_id):
+                        write_event_log(
+                            f"Job {job['id']} was finished after its lease "
+                            'was lost',
+                            'JobWorker.complete_job',
+                        )
+                finally:
+                    _current.lease = None
+
+    def _run_job(self, job:dict):
+        payload = job['payload']
+        api_key = self._get_api_key(payload['client_id'])
+        if job['kind'] == 'account':
+            dictionary_attributes = self.pipeline.process_account({
+                'client_id': payload['client_id'],
+                'api_key': api_key,
+            })
+            if not self.dictionaries:
+                return
+            if dictionary_attributes is None:
+                category_ids = self.pipeline.select_category_ids(
+                    payload['client_id'],
+                )
+                dictionary_attributes = (
+                    self.db.get_dictionary_attributes(category_ids)
+                    if category_ids else dict()
+                )
+            self.db.enqueue_jobs('dictionary', {
+                f'dictionary:{_category}:{_attribute}': {
+                    'client_id': payload['client_id'],
+                    'category_id': _category,
+                    'attribute_id': _attribute,
+                }
+                for _category in dictionary_attributes
+                for _attribute in dictionary_attributes[_category]
+            })
+        elif job['kind'] == 'dictionary':
+            self.pipeline.record_dictionary(
+                OzonApi(
+                    payload['client_id'],
+                    api_key,
+                    self.pipeline.transport,
+                ),
+                payload['category_id'],
+                payload['attribute_id'],
+            )
+        else:
+            raise ValueError(f"Unknown job kind '{job['kind']}'")
+
+    def _get_api_key(self, client_id)->str:
+        with self._api_keys_lock:
+            if client_id not in self._api_keys:
+                self._api_keys = {
+                    _entry['client_id']: _entry['api_key']
+                    for _entry in self.db.get_credentials(mp_id=1)
+                }
+            return self._api_keys[client_id]